@@ -1,8 +1,13 @@
 #!/usr/bin/python
 # A mockup of the RPi.GPIO library to allow arena.py to run while not actually
 # on a Raspberry Pi...
+# It keeps track of the pin states (so that the dotstar mockup can tell which
+# panels a transfer goes to), counts the pin changes, and can simulate the
+# time they take.
 # Daniel Vedder, August 2019
 
+import time
+
 global BCM, BOARD
 BCM = 0
 BOARD = 1
@@ -15,20 +20,61 @@ global IN,OUT
 IN = 0
 OUT = 1
 
+# The current value of each pin that has been set up or written to
+global state
+state = {}
+
+# If simulate is true, each call to output() takes `latency` seconds per pin
+# (roughly what RPi.GPIO needs on a Raspberry Pi 3)
+global simulate, latency
+simulate = False
+latency = 0.000005
+
+# The number of calls to output(), and of pins written by them (not in the
+# real library)
+global calls, writes
+calls, writes = 0, 0
+
+def reset_counts():
+    "Reset the call and write counters (not in the real library)."
+    global calls, writes
+    calls, writes = 0, 0
+
 def setmode(mode):
     pass
 
 def cleanup():
-    pass
+    global state
+    state = {}
 
 def setup(pin, direction):
-    pass
+    global state
+    state[pin] = LOW
 
 def input(pin):
-    return 0
+    global state
+    return state.get(pin, LOW)
 
 def output(pin, data):
-    pass
+    global state, simulate, latency, calls, writes
+    # like the real library, this accepts single pins/values or sequences
+    if isinstance(pin, (list, tuple)): pins = pin
+    else: pins = [pin]
+    if isinstance(data, (list, tuple)): values = data
+    else: values = [data] * len(pins)
+    for p, v in zip(pins, values):
+        state[p] = v
+    calls += 1
+    writes += len(pins)
+    if simulate:
+        # busy-wait, as the real pin changes keep the CPU busy too
+        end = time.time() + latency * len(pins)
+        while time.time() < end: pass
+
+def high_pins():
+    "Return the pins that are currently set to HIGH (not in the real library)."
+    global state
+    return tuple(sorted(p for p in state if state[p] == HIGH))
 
 def gpio_func(pin):
     global IN
@@ -10,7 +10,8 @@
 ### University of Wuerzburg, Center for Computational and Theoretical Biology
 ### Licensed under the terms of the GNU GPLv3
 
-import sys, copy
+import sys, copy, time, zlib, array, struct, itertools, collections
+import threading, Queue
 import RPi.GPIO as GPIO              #https://pypi.org/project/RPi.GPIO/
 from dotstar import Adafruit_DotStar #https://github.com/adafruit/Adafruit_DotStar_Pi
 
@@ -36,25 +37,65 @@ toggle = 25
 global pins
 pins = (5, 6, 13, 19, 26, 16, 20, 21)
 
+# Which panels are selected to receive updates (panel_on), and which of the
+# panel pins are actually turned on at the moment (pin_mask, bit i stands for
+# pins[i])
+global panel_on, pin_mask
+panel_on = [False] * len(pins)
+pin_mask = 0
+
+def init_panels():
+    "Select the panels that receive updates by default in the current mode"
+    global MODE, pins, panel_on
+    if MODE == "SERIAL" or MODE == "DUPLICATE": panel_on = [True] * len(pins)
+    else: panel_on = [False] * len(pins)
+
+init_panels()
+
 def init_GPIO():
     "(Re)initialise the Raspberry Pi GPIO pins"
-    global MODE, toggle, pins
+    global MODE, toggle, pins, pin_mask
+    pin_mask = 0
     if MODE == "TEXT": return
     GPIO.setmode(GPIO.BCM)
     GPIO.setup(toggle, GPIO.OUT)
     GPIO.output(toggle, GPIO.LOW)
     for p in pins:
         GPIO.setup(p, GPIO.OUT)
-        GPIO.output(p, GPIO.LOW)
+    GPIO.output(list(pins), GPIO.LOW)
     # Toggle the hardware mode if necessary
     if MODE == "SERIAL":
         GPIO.output(toggle, GPIO.HIGH)
     # Turn on the panel pins if necessary
     if MODE == "SERIAL" or MODE == "DUPLICATE":
-        for p in pins:
-            GPIO.output(p, GPIO.HIGH)
+        set_pins((1 << len(pins)) - 1)
+
+## The panel pins are switched with bitmasks. All pins that need to change
+## are written in a single GPIO call, and pins that are already in the right
+## state are not written at all.
+
+# The pins and values to write for each combination of changed pins and their
+# new values (filled in as they are needed)
+global pin_writes
+pin_writes = {}
 
-init_GPIO() #should be initialised when module first loads
+def set_pins(mask):
+    '''
+    Turn on the panel pins whose bits are set in mask (bit i stands for
+    `pins[i]`), and turn off all others.
+    '''
+    global pins, pin_mask, pin_writes
+    changed = mask ^ pin_mask
+    if not changed: return
+    key = (changed, mask & changed)
+    if key not in pin_writes:
+        bits = [i for i in range(len(pins)) if changed >> i & 1]
+        pin_writes[key] = ([pins[i] for i in bits],
+                           [GPIO.HIGH if mask >> i & 1 else GPIO.LOW
+                            for i in bits])
+    channels, values = pin_writes[key]
+    GPIO.output(channels, values)
+    pin_mask = mask
 
 ## LED STRIP SETUP
 
@@ -82,38 +123,162 @@ init_dimensions()
 global spi_clock
 spi_clock = 10000000 # 10 MHz
 
+def transfer_time(nleds=None):
+    '''
+    Estimate the seconds needed to send data for nleds LEDs (default: one
+    panel) at the SPI clockrate. APA102 strips need a 4 byte start frame,
+    4 bytes per LED, and an end frame of at least one bit per two LEDs.
+    '''
+    global spi_clock, height, pwidth
+    if nleds is None: nleds = height*pwidth
+    return (4 + nleds*4 + (nleds+15)//16) * 8.0 / spi_clock
+
+## COLOURS
+
+def colour_bytes(r, g, b):
+    '''
+    Pack an RGB value into the four bytes that one APA102 LED expects on the
+    wire (a 0xFF header/brightness byte, followed by blue, green and red).
+    This matches what `strip.Color(g, r, b)` produced with the DotStar
+    library's default BRG byte order.
+    '''
+    return bytes(bytearray((0xFF, b, g, r)))
+
+## Each colour maps to its packed LED value (for arena output) and a letter
+## (for ASCII output)
+global colours, colour_names
+colours = {"black":(colour_bytes(0, 0, 0), "-"),
+           "red":(colour_bytes(15, 0, 0), "R"),
+           "green":(colour_bytes(0, 1, 0), "G"),
+           "blue":(colour_bytes(0, 0, 1), "B"),
+           "orange":(colour_bytes(5, 2, 0), "O"),
+           "magenta":(colour_bytes(5, 0, 7), "M"),
+           "yellow":(colour_bytes(10, 10, 0), "Y"),
+           "cyan":(colour_bytes(0, 10, 10), "C")}
+# reverse lookup table, to find the name of a pixel's colour
+colour_names = dict((v[0], k) for k, v in colours.items())
+
+## Besides the names above, colours may be given as (r, g, b) tuples (0-255).
+## These are packed once and then kept in this cache.
+global colour_cache
+colour_cache = {}
+
+def colour_value(colour):
+    "Get the packed LED value of a colour name or an (r, g, b) tuple."
+    global colours, colour_cache, gamma
+    try:
+        if colour in colours: return colours[colour][0]
+        value = colour_cache.get(colour)
+    except TypeError:
+        # (e.g. a list, which can't be looked up)
+        value = None
+    if value is None:
+        if isinstance(colour, str):
+            raise Exception("Unknown colour "+colour)
+        if not isinstance(colour, tuple) or len(colour) != 3:
+            raise Exception("Invalid colour "+repr(colour)+
+                            " (use a name or an (r, g, b) tuple)")
+        for c in colour:
+            if not isinstance(c, (int, long, float)) or c != int(c) or \
+               c < 0 or c > 255:
+                raise Exception("Invalid colour "+repr(colour))
+        # tuples are perceptual values, so they are gamma corrected
+        value = colour_bytes(*[int(round(255*(c/255.0)**gamma))
+                               for c in colour])
+        colour_cache[colour] = value
+    return value
+
+def add_colour(name, r, g, b, symbol="*"):
+    "Add a named colour (with a letter for ASCII output)."
+    global colours, colour_names
+    if name in colours: del colour_names[colours[name][0]]
+    colours[name] = (colour_bytes(r, g, b), symbol)
+    colour_names[colours[name][0]] = name
+
+## Brightness and gamma correction. The brightness is set with the 5-bit
+## global brightness field of each LED's header byte (`0xE0 | level`), which
+## `output()` writes as the data is sent, so the dim colour values of the
+## palette keep their full resolution and the brightness can change without
+## redrawing. Gamma correction only applies to colours given as (r, g, b)
+## tuples, which are perceptual 0-255 values: they are corrected when they
+## are packed. The named colours are raw LED values and are not corrected.
+global brightness, gamma, header_byte
+brightness, gamma = 1.0, 1.0
+header_byte = 0xFF
+
+def set_brightness(new_brightness=1.0, new_gamma=1.0):
+    '''
+    Set the brightness of all LEDs (0-1, in 32 steps of the APA102 global
+    brightness), and the gamma correction of (r, g, b) colours
+    (`value = 255 * (value/255)**new_gamma`). The brightness takes effect
+    with the next `render()`, which resends every panel. A new gamma only
+    applies to tuple colours drawn from then on.
+    '''
+    global brightness, gamma, header_byte, colour_cache
+    global shown, changed_panels, pins, npanels
+    if new_brightness < 0 or new_brightness > 1 or new_gamma <= 0:
+        raise Exception("Invalid brightness "+str(new_brightness)+
+                        " or gamma "+str(new_gamma))
+    if float(new_gamma) != gamma: colour_cache = {}
+    brightness, gamma = float(new_brightness), float(new_gamma)
+    header_byte = 0xE0 | int(round(31*brightness))
+    # the panels show data with the old brightness
+    shown = [None] * len(pins)
+    changed_panels = [True] * npanels
+
 ## Adafruit strip object and internal representations of the strip buffer
 global strip, arena, changed_panels
+strip, arena = None, None
+
+## The data last sent to each panel (indexed by pin, None if unknown), and
+## counters of how many panel updates were pushed or skipped as unchanged,
+## and how many transfers were needed to push them
+global shown, render_stats
+render_stats = {"pushed": 0, "skipped": 0, "transfers": 0}
+
+## If this is set to a function, `render()` passes it the list of updates as
+## (pin mask, data) pairs, instead of sending them to the device
+global sink
+sink = None
 
 def init_arena():
-    "Create the strip and buffer objects"
-    global strip, arena, changed_panels
-    global spi_clock, height, pwidth, width, npanels
-    strip = Adafruit_DotStar(height*pwidth, spi_clock)
-    strip.begin()
-    #TODO For maximum speed, use a byte array of RGB values instead
-    # (see `image-pov.py` in the Adafruit library for example code)
-    arena = ["black"] * height * width
+    "Create (or clear) the buffer objects"
+    global arena, changed_panels, shown, terminal_shown
+    global height, width, npanels
+    # The buffer holds the raw APA102 data for every LED, in strip order.
+    # Each panel is therefore a contiguous slice that can be passed straight
+    # to `strip.show()` (cf. `image-pov.py` in the Adafruit library).
+    black = colours["black"][0] * height * width
+    if arena is not None and len(arena) == len(black): arena[:] = black
+    else: arena = bytearray(black)
     changed_panels = [False] * npanels
+    shown = [None] * len(pins)
+    terminal_shown = None
 
 init_arena()
 
-global colours
-colours = {"black":(strip.Color(0, 0, 0), "-"),
-           "red":(strip.Color(0, 15, 0), "R"),
-           "green":(strip.Color(1, 0, 0), "G"),
-           "blue":(strip.Color(0, 0, 1), "B"),
-           "orange":(strip.Color(2,5,0), "O"),
-           "magenta":(strip.Color(0, 5, 7), "M"),
-           "yellow":(strip.Color(10, 10, 0), "Y"),
-           "cyan":(strip.Color(10, 0, 10), "C")}
+## The hardware (GPIO pins and strip) is only set up when the first update is
+## sent, so that importing the module and switching modes are fast
+global hardware_ready
+hardware_ready = False
+
+def init_hardware():
+    "Set up the GPIO pins for the current mode, and the strip if necessary"
+    global MODE, strip, spi_clock, height, pwidth, hardware_ready
+    if MODE == "TEXT": return
+    init_GPIO()
+    # the strip can be reused unless its length changes
+    if strip is None or strip.numPixels() != height*pwidth:
+        strip = Adafruit_DotStar(height*pwidth, spi_clock)
+        strip.begin()
+    hardware_ready = True
 
 ## ARENA FUNCTIONS
 
 def clear(colour="black", show=True):
     "Reset the arena to a given colour (default: black/off)"
-    global arena, npanels, changed_panels
-    for a in range(len(arena)): arena[a] = colour
+    global arena, npanels, changed_panels, height, width
+    arena[:] = colour_value(colour) * height * width
     changed_panels = [True] * npanels
     if show: render()
 
@@ -135,53 +300,984 @@ def pixel_id(x, y, toroidal=True):
         return (x+1)*height - y - 1
     else: return x*height + y
 
+## Lookup tables from coordinates to buffer offsets (`pixel_map[y][x]`, or
+## `pixel_offsets[y*width + x]`), and the LED index of each pixel as a NumPy
+## array (`pixel_index[y*width + x]`, built when it is first needed)
+global pixel_map, pixel_offsets, pixel_index
+
+def init_pixel_map():
+    '''
+    Precompute the buffer offset of every pixel in the current mode, so that
+    drawing doesn't have to redo the serpentine arithmetic for each pixel.
+    (All panels share the same layout, so panel p's table is simply the
+    slice `pixel_map[y][p*pwidth:(p+1)*pwidth]` of each row.)
+    '''
+    global pixel_map, pixel_offsets, pixel_index, height, width
+    pixel_map = [[pixel_id(x, y)*4 for x in range(width)]
+                 for y in range(height)]
+    pixel_offsets = [pid for row in pixel_map for pid in row]
+    pixel_index = None
+
+init_pixel_map()
+
 def pixel(x,y):
-    "Get the colour of this pixel."
-    global arena
-    return arena[pixel_id(x,y)]    
+    "Get the colour of this pixel (its name, or an (r, g, b) tuple)."
+    global arena, colour_names, pixel_map, height, width
+    pid = pixel_map[y % height][x % width]
+    value = bytes(arena[pid:pid+4])
+    if value in colour_names: return colour_names[value]
+    b, g, r = bytearray(value)[1:]
+    return (r, g, b)
 
 ## PLOTTING FUNCTIONS
 
 def set_pixel(x,y,colour):
     "Set the colour of a single pixel."
-    global arena, changed_panels, pwidth, height
-    pid = pixel_id(x,y)
-    arena[pid] = colour
-    #prior to v3, Python doesn't convert to float when dividing ints
-    changed_panels[pid/(pwidth*height)] = True
+    global arena, changed_panels, pixel_map, pwidth, height, width
+    x, y = x % width, y % height
+    pid = pixel_map[y][x]
+    arena[pid:pid+4] = colour_value(colour)
+    changed_panels[x // pwidth] = True
+
+## BULK PLOTTING FUNCTIONS
+## These draw many pixels in one call, which is much faster than calling
+## `set_pixel()` for each of them. NumPy is optional and never imported here
+## (it takes longer to load than the rest of the module): NumPy arrays of
+## coordinates or masks are drawn without looping over their elements, and a
+## caller that passes them has already imported it.
+
+def fill_indices(numpy, indices, value):
+    '''
+    Set the pixels at the given indices (`y*width + x`, a NumPy array) to a
+    packed LED value in one vectorized assignment.
+    '''
+    global arena, changed_panels, pixel_index, pixel_offsets, pwidth, width
+    if len(indices) == 0: return
+    if pixel_index is None:
+        pixel_index = numpy.array(pixel_offsets, numpy.intp) // 4
+    # each LED is four bytes, so the buffer can be seen as an array of them
+    leds = numpy.frombuffer(arena, numpy.uint32)
+    leds[pixel_index[indices]] = numpy.frombuffer(bytes(value), numpy.uint32)
+    for p in numpy.unique(indices % width // pwidth):
+        changed_panels[p] = True
+
+def set_pixels(coords, colour, dx=0, dy=0):
+    '''
+    Set the colour of all pixels in a sequence of (x, y) pairs (e.g. a list
+    of coordinates or an Nx2 NumPy array), optionally moved by dx/dy.
+    '''
+    global arena, changed_panels, pixel_map, pwidth, height, width
+    value = colour_value(colour)
+    numpy = sys.modules.get("numpy")
+    if numpy is not None and isinstance(coords, numpy.ndarray):
+        coords = coords.reshape(-1, 2)
+        fill_indices(numpy, (coords[:,1]+dy) % height * width +
+                     (coords[:,0]+dx) % width, value)
+        return
+    # local names are faster to look up in the loop
+    buf, rows, changed = arena, pixel_map, changed_panels
+    w, h, pw = width, height, pwidth
+    for x, y in coords:
+        x = (x+dx) % w
+        pid = rows[(y+dy) % h][x]
+        buf[pid:pid+4] = value
+        changed[x // pw] = True
+
+def fill_spans(spans, colour, dx=0, dy=0):
+    "Set the colour of all pixels in a list of (y, x1, x2) spans (moved by dx/dy)."
+    global arena, changed_panels, pixel_map, pwidth, height, width, npanels
+    value = colour_value(colour)
+    buf, changed = arena, changed_panels
+    for y, x1, x2 in spans:
+        if x2 < x1: x2,x1 = x1,x2
+        x1, x2 = x1+dx, x2+dx
+        row = pixel_map[(y+dy) % height]
+        if 0 <= x1 and x2 < width: offsets = row[x1:x2+1]
+        else: offsets = [row[x % width] for x in range(x1, x2+1)]
+        for pid in offsets:
+            buf[pid:pid+4] = value
+        for p in range(x1//pwidth, min(x2//pwidth, x1//pwidth+npanels-1)+1):
+            changed[p % npanels] = True
+
+def set_mask(mask, colour):
+    '''
+    Set the colour of every pixel whose entry in mask is true. The mask is a
+    flat sequence of width*height values in row order, i.e. the entry for
+    x/y is at `mask[y*width + x]` (e.g. a boolean NumPy array, which may
+    also have the shape (height, width)).
+    '''
+    global arena, changed_panels, pixel_offsets, pwidth, height, width
+    value = colour_value(colour)
+    numpy = sys.modules.get("numpy")
+    if numpy is not None and isinstance(mask, numpy.ndarray):
+        fill_indices(numpy, numpy.flatnonzero(mask), value)
+        return
+    columns = set()
+    for i in itertools.compress(range(width*height), mask):
+        pid = pixel_offsets[i]
+        arena[pid:pid+4] = value
+        columns.add(i % width)
+    for p in set(x // pwidth for x in columns):
+        changed_panels[p] = True
+
+def fill_columns(x1, x2, colour, y1=0, y2=None):
+    '''
+    Set all pixels in columns x1 to x2 to the given colour (optionally only
+    those in rows y1 to y2). Columns are stored contiguously, so whole columns
+    need only one or two slice assignments, and partial ones one per column.
+    '''
+    global arena, changed_panels, height, width, pwidth
+    value = colour_value(colour)
+    if y2 is None: y2 = height-1
+    if y2 < y1: y2,y1 = y1,y2
+    if x2 < x1: x2,x1 = x1,x2
+    if x2 - x1 >= width - 1: x1, x2 = 0, width - 1
+    else: x1, x2 = x1 % width, x2 % width
+    if x2 < x1: ranges = ((x1, width-1), (0, x2)) # wrap around
+    else: ranges = ((x1, x2),)
+    if y2 - y1 >= height - 1: rows = None # whole columns
+    else:
+        y1, y2 = y1 % height, y2 % height
+        if y2 < y1: rows = ((y1, height-1), (0, y2))
+        else: rows = ((y1, y2),)
+    for start, end in ranges:
+        if rows is None:
+            arena[start*height*4:(end+1)*height*4] = \
+                value * (end-start+1) * height
+        else:
+            for x in range(start, end+1):
+                for ya, yb in rows:
+                    # odd columns run bottom to top
+                    if x%2 == 1: ya, yb = height-yb-1, height-ya-1
+                    arena[(x*height+ya)*4:(x*height+yb+1)*4] = \
+                        value * (yb-ya+1)
+        for p in range(start//pwidth, end//pwidth+1):
+            changed_panels[p] = True
     
+## SCROLLING
+## Most stimuli are rotations of a fixed pattern around the arena, so instead
+## of redrawing the pattern at a new offset every frame, the buffer can be
+## scrolled. Odd columns run bottom to top, so a pixel row is gathered from
+## the buffer with two strided slices (even and odd columns), which keeps the
+## work per row in C.
+
+def get_row(pixels, y):
+    "Get row y of an array of 32-bit pixels in strip order, from left to right."
+    global height, width
+    row = array.array('I', [0]) * width
+    row[0::2] = pixels[y::2*height]
+    row[1::2] = pixels[2*height-y-1::2*height]
+    return row
+
+def put_row(pixels, y, row):
+    "Write a row of pixels (see `get_row()`) back into an array in strip order."
+    global height
+    pixels[y::2*height] = row[0::2]
+    pixels[2*height-y-1::2*height] = row[1::2]
+
+def scroll(dx, dy=0, x1=0, x2=None, y1=0, y2=None):
+    '''
+    Shift the arena contents dx pixels to the right and dy pixels down,
+    wrapping around at the edges. Optionally, only the rectangle from x1/y1
+    to x2/y2 is scrolled (wrapping around within it), so that e.g. different
+    bands of rows can rotate in opposite directions.
+    '''
+    global arena, changed_panels, height, width, pwidth, npanels
+    if x2 is None: x2 = width-1
+    if y2 is None: y2 = height-1
+    # the columns and rows of the rectangle (which may wrap around the arena)
+    if x2 < x1: x2,x1 = x1,x2
+    if y2 < y1: y2,y1 = y1,y2
+    ncols = min(x2-x1+1, width)
+    nrows = min(y2-y1+1, height)
+    x1, y1 = x1 % width, y1 % height
+    dx, dy = dx % ncols, dy % nrows
+    if dx == 0 and dy == 0: return
+    if nrows == height and dy == 0 and x1+ncols <= width and ncols % 2 == 0:
+        # whole columns are contiguous in the buffer, so they can be rotated
+        # as one block (but an odd shift turns every column upside down)
+        cbytes = height*4
+        block = arena[x1*cbytes:(x1+ncols)*cbytes]
+        block = block[(ncols-dx)*cbytes:] + block[:(ncols-dx)*cbytes]
+        if dx % 2 == 1:
+            pixels = array.array('I', bytes(block))
+            flipped = pixels[:]
+            for y in range(height):
+                flipped[y::height] = pixels[height-y-1::height]
+            block = flipped.tostring()
+        arena[x1*cbytes:(x1+ncols)*cbytes] = block
+    else:
+        pixels = array.array('I', bytes(arena[:]))
+        rows = [get_row(pixels, (y1+i) % height) for i in range(nrows)]
+        for i in range(nrows):
+            # move the rectangle to the start of the row, replace it with the
+            # rotated part of the source row, and move it back
+            src, row = rows[(i-dy) % nrows], rows[i]
+            src, row = src[x1:] + src[:x1], row[x1:] + row[:x1]
+            row = src[ncols-dx:ncols] + src[:ncols-dx] + row[ncols:]
+            row = row[width-x1:] + row[:width-x1]
+            put_row(pixels, (y1+i) % height, row)
+        arena[:] = pixels.tostring()
+    for x in range(x1, x1+ncols, pwidth):
+        changed_panels[(x // pwidth) % npanels] = True
+    changed_panels[((x1+ncols-1) // pwidth) % npanels] = True
+
+## LAYERS
+## The arena can be composed of a static background and a stack of sprites
+## on top of it. The background is drawn once and kept as a snapshot of the
+## buffer. Sprites are shapes (lists of spans) with a colour and a position,
+## drawn in the order they were added. When a sprite changes, `render()`
+## repaints only the pixels it covered and now covers, so the cost of a frame
+## depends on what moves, not on the size of the arena.
+## (Drawing directly to the arena while layers are in use is not undone
+## by the compositor, so draw static elements into the background instead.)
+
+## The background snapshot (None -> black), the sprites (name -> properties),
+## and the buffer offsets that must be repainted before the next render
+global background, sprites, dirty
+
+def clear_layers():
+    "Remove the background and all sprites."
+    global background, sprites, dirty
+    background = None
+    sprites = collections.OrderedDict()
+    dirty = set()
+
+def set_background(draw_fn=None):
+    '''
+    Use the current contents of the arena as the background, or clear it and
+    call draw_fn() to draw a new one. The sprites are then redrawn on top.
+    '''
+    global arena, background, sprites, dirty
+    if draw_fn is not None:
+        clear("black", show=False)
+        draw_fn()
+    background = bytes(arena[:])
+    for s in sprites.values():
+        dirty.update(s["cover"])
+
+def sprite_cover(spans, x, y):
+    "Get the buffer offsets of the pixels covered by spans moved to x/y."
+    global pixel_map, height, width
+    cover = set()
+    for sy, x1, x2 in spans:
+        if x2 < x1: x2,x1 = x1,x2
+        row = pixel_map[(sy+y) % height]
+        cover.update(row[sx % width] for sx in range(x1+x, x2+x+1))
+    return frozenset(cover)
+
+def set_sprite(name, spans=None, colour=None, x=None, y=None):
+    '''
+    Add a sprite, or change its shape, colour or position. (New sprites need
+    spans and a colour, and are drawn on top of all existing ones.)
+    spans: The shape as a list of (y, x1, x2) spans (e.g. from `shape.py`
+           with `spans=True`), relative to the sprite's position
+    x, y: The sprite's position (default: 0/0)
+    '''
+    global sprites, dirty
+    if colour is not None: colour_value(colour) # check that it is valid
+    sprite = sprites.get(name)
+    if sprite is None:
+        if spans is None or colour is None:
+            raise Exception("New sprite "+str(name)+" needs spans and a colour.")
+        sprite = {"spans": None, "colour": None, "x": 0, "y": 0,
+                  "cover": frozenset()}
+        sprites[name] = sprite
+    new = dict(sprite)
+    if spans is not None: new["spans"] = list(spans)
+    if colour is not None: new["colour"] = colour
+    if x is not None: new["x"] = x
+    if y is not None: new["y"] = y
+    if new == sprite: return
+    dirty.update(sprite["cover"])
+    new["cover"] = sprite_cover(new["spans"], new["x"], new["y"])
+    dirty.update(new["cover"])
+    sprite.update(new)
+
+def remove_sprite(name):
+    "Remove a sprite, revealing what lies beneath it."
+    global sprites, dirty
+    if name not in sprites:
+        raise Exception("No such sprite: "+str(name))
+    dirty.update(sprites.pop(name)["cover"])
+
+def compose():
+    '''
+    Repaint the pixels affected by sprite changes since the last call, and
+    mark their panels as changed. (`render()` calls this automatically.)
+    '''
+    global arena, background, sprites, dirty, changed_panels, colours
+    global height, pwidth, profiling
+    if not dirty: return
+    if profiling: begin = monotonic()
+    if background is None: black = colour_value("black")
+    for pid in dirty:
+        if background is None: arena[pid:pid+4] = black
+        else: arena[pid:pid+4] = background[pid:pid+4]
+    for sprite in sprites.values():
+        value = colour_value(sprite["colour"])
+        for pid in sprite["cover"] & dirty:
+            arena[pid:pid+4] = value
+    # each panel is a contiguous part of the buffer
+    pbytes = pwidth*height*4
+    for p in set(pid // pbytes for pid in dirty):
+        changed_panels[p] = True
+    dirty = set()
+    if profiling: profile_time("compose", monotonic() - begin)
+
+clear_layers()
+
 def print_arena():
     "Print out a text representation of the current state of the arena."
-    global height, width, colours
-    for y in range(height):
-        for x in range(width):
-            sys.stdout.write(colours[pixel(x,y)][1])
-        sys.stdout.write('\n')
+    global arena, colours, colour_names, pixel_map
+    lines = []
+    for row in pixel_map:
+        line = []
+        for pid in row:
+            value = bytes(arena[pid:pid+4])
+            if value in colour_names: line.append(colours[colour_names[value]][1])
+            else: line.append("*") # not a named colour
+        lines.append("".join(line))
+    sys.stdout.write("\n".join(lines) + "\n")
+    sys.stdout.flush()
+
+## TERMINAL OUTPUT
+## In TEXT mode, a true-colour terminal shows two pixel rows per character
+## cell: an upper half block in the colour of the upper pixel, on a background
+## in the colour of the lower one. The picture is as wide as the arena in
+## columns, and is redrawn in place, sending only the cells that changed since
+## the last frame. Terminals that are too narrow get the ASCII output.
+
+## The buffer contents last drawn to the terminal (None -> redraw all), and
+## the colour of each LED value for the escape sequences
+global terminal_shown, terminal_colours
+terminal_shown = None
+terminal_colours = {}
+
+def terminal_colour(value):
+    "Get the 'r;g;b' string of an LED value for an ANSI colour sequence."
+    global terminal_colours
+    colour = terminal_colours.get(value)
+    if colour is None:
+        b, g, r = bytearray(value)[1:]
+        # the LEDs are run very dimly, so show the hue at full brightness
+        brightest = max(r, g, b)
+        if brightest: r, g, b = [c*255 // brightest for c in (r, g, b)]
+        colour = "%d;%d;%d" % (r, g, b)
+        terminal_colours[value] = colour
+    return colour
+
+def terminal_width():
+    "Get the width of the terminal on stdout in columns (0 if unknown)."
+    try:
+        import fcntl, termios
+        size = fcntl.ioctl(sys.stdout.fileno(), termios.TIOCGWINSZ, "\0"*4)
+        return struct.unpack("hh", size)[1]
+    except Exception:
+        return 0
+
+def print_terminal():
+    '''
+    Draw the arena in a true-colour terminal, redrawing only the cells that
+    have changed since the last call.
+    '''
+    global arena, terminal_shown, pixel_map, height, width
+    old = terminal_shown
+    if old is not None and len(old) != len(arena): old = None
+    parts = []
+    if old is None: parts.append("\x1b[2J") # clear the screen
+    cbytes = height*4
+    code = None
+    for x in range(width):
+        # columns are contiguous, so unchanged ones can be skipped at once
+        start = x*cbytes
+        if old is not None and arena[start:start+cbytes] == old[start:start+cbytes]:
+            continue
+        for y in range(0, height, 2):
+            top = pixel_map[y][x]
+            top = bytes(arena[top:top+4])
+            if y+1 < height:
+                bottom = pixel_map[y+1][x]
+                bottom = bytes(arena[bottom:bottom+4])
+            else: bottom = None
+            if old is not None:
+                pid = pixel_map[y][x]
+                if old[pid:pid+4] == top and (bottom is None or
+                   old[pixel_map[y+1][x]:pixel_map[y+1][x]+4] == bottom):
+                    continue
+            c = "\x1b[38;2;%sm" % terminal_colour(top)
+            if bottom is None: c = c + "\x1b[49m"
+            else: c = c + "\x1b[48;2;%sm" % terminal_colour(bottom)
+            if c != code:
+                parts.append(c)
+                code = c
+            # (an upper half block, in UTF-8)
+            parts.append("\x1b[%d;%dH\xe2\x96\x80" % (y//2+1, x+1))
+    if parts:
+        # reset the colour and leave the cursor below the picture
+        parts.append("\x1b[0m\x1b[%d;1H" % ((height+1)//2+1))
+        sys.stdout.write("".join(parts))
         sys.stdout.flush()
+    terminal_shown = bytearray(arena)
 
 def render():
     "Output the current state of the arena to the device"
     #TODO needs to be tested
-    global MODE, strip, arena, pins, changed_panels
-    global height, width, pwidth, colour, npanels
+    global MODE, arena, pins, changed_panels, shown, render_stats, sink
+    global height, pwidth, npanels, profiling, frame_logging, render_count
+    compose()
     # text mode is handled by a different function
     if MODE == "TEXT":
-        print_arena()
+        if sys.stdout.isatty() and terminal_width() >= width:
+            print_terminal()
+        else: print_arena()
         return
-    # update each panel that has been changed
+    render_count += 1
+    if profiling: begin = monotonic()
+    # collect the data for each panel that has been changed
+    pbytes = pwidth*height*4
+    pending, order = {}, []
     for p in range(npanels):
         if not changed_panels[p]: continue
-        # make sure to activate a panel when in parallel mode
-        if MODE == "PARALLEL": GPIO.output(pins[p], GPIO.HIGH)
-        for y in range(height):
-            for x in range(pwidth):
-                pid = pixel_id(x+(p*pwidth), y)
-                col = colours[arena[pid]][0]
-                spid = pid - (p*pwidth*height)
-                strip.setPixelColor(spid, col)
-        strip.show()
-        if MODE == "PARALLEL": GPIO.output(pins[p], GPIO.LOW)
         changed_panels[p] = False
+        # the buffer is already in strip order, so it can be sent as is
+        data = arena[p*pbytes:(p+1)*pbytes]
+        # don't resend data that all receiving panels are showing already
+        if MODE == "PARALLEL": targets = [p]
+        else: targets = [i for i in range(len(pins)) if panel_on[i]]
+        if all(shown[i] == data for i in targets):
+            render_stats["skipped"] += 1
+            continue
+        for i in targets: shown[i] = data
+        # panels with identical content share a single transfer
+        key = bytes(data)
+        if key not in pending:
+            pending[key] = [0, data]
+            order.append(key)
+        for i in targets: pending[key][0] |= 1 << i
+        render_stats["pushed"] += 1
+    updates = [tuple(pending[key]) for key in order]
+    render_stats["transfers"] += len(updates)
+    if profiling: profile_time("render", monotonic() - begin)
+    # the frame the updates belong to, for the frame log
+    if frame_logging: info = (frame_number, render_count, frame_lateness)
+    else: info = None
+    if sink is not None: sink(updates)
+    elif output_thread is not None:
+        # the updates are copies of the buffer, so drawing can continue
+        # while the output thread sends them
+        check_output_thread()
+        output_queue.put((updates, info))
+    else:
+        for mask, data in updates: output(mask, data, info)
+
+def output(mask, data, info=None):
+    '''
+    Send raw strip data to the device, activating the panels whose bits are set
+    in mask (bit i corresponds to `pins[i]`). info is the frame number,
+    render count and lateness for the frame log (default: the current ones).
+    '''
+    global MODE, strip, profiling, header_byte, hardware_ready, frame_logging
+    if not hardware_ready: init_hardware()
+    if frame_logging: digest = zlib.crc32(buffer(data))
+    if profiling: begin = monotonic()
+    if header_byte != 0xFF:
+        # set the global brightness of each LED
+        data = bytearray(data)
+        data[0::4] = chr(header_byte) * (len(data)//4)
+    # the pins stay on between updates (nothing is sent in between), so only
+    # those that differ are switched
+    set_pins(mask)
+    if profiling: switched = monotonic()
+    strip.show(data)
+    if frame_logging: log_update(mask, digest, info)
+    if profiling:
+        sent = monotonic()
+        profile_time("gpio", switched - begin, mask)
+        profile_time("show", sent - switched, mask)
+
+## DOUBLE BUFFERING
+
+## When double buffering is on, `render()` hands its updates to a separate
+## output thread, so the next frame can be drawn while this one is being sent
+global output_thread, output_queue, output_error
+output_thread = None
+output_queue = None
+output_error = None
+
+def output_worker():
+    "Send the updates passed to the output queue, until it receives None."
+    global output_queue, output_error
+    while True:
+        item = output_queue.get()
+        try:
+            if item is None: return
+            updates, info = item
+            if output_error is None:
+                for mask, data in updates: output(mask, data, info)
+        except Exception as e:
+            output_error = e
+        finally:
+            output_queue.task_done()
+
+def check_output_thread():
+    "Raise any error that occurred in the output thread."
+    global output_error
+    if output_error is not None:
+        e, output_error = output_error, None
+        raise e
+
+def set_double_buffer(enabled=True):
+    '''
+    Turn double buffering on or off. While it is on, `render()` returns as soon
+    as the previous frame has been sent. Use `wait()` to block until the
+    current frame has been sent, too.
+    '''
+    global output_thread, output_queue
+    if enabled and output_thread is None:
+        # one frame may wait while another one is being sent
+        output_queue = Queue.Queue(1)
+        output_thread = threading.Thread(target=output_worker)
+        output_thread.daemon = True
+        output_thread.start()
+    elif not enabled and output_thread is not None:
+        try:
+            wait()
+        finally:
+            output_queue.put(None)
+            output_thread.join()
+            output_thread, output_queue = None, None
+
+def wait():
+    "Block until all rendered frames have been sent to the device."
+    global output_queue
+    if output_queue is not None: output_queue.join()
+    check_output_thread()
+
+## FRAME SCHEDULING
+
+## Python 2 has no monotonic clock in the `time` module, so use the one
+## provided by the C library (falling back to the wall clock if unavailable)
+try:
+    from time import monotonic
+except ImportError:
+    try:
+        import ctypes
+        class _timespec(ctypes.Structure):
+            _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+        # (ctypes.util.find_library() would run ldconfig, which is slow)
+        try: _librt = ctypes.CDLL("librt.so.1")
+        except OSError: _librt = ctypes.CDLL("libc.so.6")
+        _clock_gettime = _librt.clock_gettime
+        _CLOCK_MONOTONIC = 1
+        def monotonic():
+            "Return the time in seconds of a clock that never goes backwards"
+            ts = _timespec()
+            _clock_gettime(_CLOCK_MONOTONIC, ctypes.byref(ts))
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+        monotonic()
+    except (OSError, AttributeError):
+        monotonic = time.time
+
+## Statistics on the frames shown by `animate()`
+global frame_stats
+frame_stats = {}
+
+def reset_frame_stats():
+    "Reset the statistics collected by `animate()`."
+    global frame_stats
+    frame_stats = {"shown": 0, "dropped": 0, "late": 0, "start": None,
+                   "end": None, "jitter_sum": 0.0, "jitter_sqsum": 0.0,
+                   "jitter_max": 0.0}
+
+reset_frame_stats()
+
+def animate(frame_fn, fps, ticks=-1, late="drop", period=None, wait=None,
+            start=None):
+    '''
+    Call frame_fn(t) for t = 0, 1, 2... at a fixed framerate. Each frame is
+    started at an absolute deadline, so that timing errors don't add up.
+    frame_fn: A function that draws and renders frame t
+    fps: The framerate in frames per second
+    ticks: The number of frames to run for (-1 -> forever)
+    late: What to do if a frame's time has already passed before it could be
+          started: "drop" skips it (frame_fn must then not depend on the
+          previous frame), "render" shows it late.
+    period: If given, t wraps around to 0 after this many frames.
+    wait: If given, wait(seconds) is called to wait for the next frame instead
+          of sleeping (e.g. to handle input in the meantime).
+    start: The deadline of the first frame (`monotonic()` time, default: now),
+           e.g. to continue a previous animation without a gap.
+    '''
+    global frame_stats, profiling, frame_number, frame_lateness
+    if late not in ("drop", "render"):
+        raise Exception("Invalid late frame policy "+str(late))
+    reset_frame_stats()
+    interval = 1.0/fps
+    if start is None: start = monotonic()
+    frame_stats["start"] = start
+    i = 0
+    try:
+        while i != ticks:
+            deadline = start + i*interval
+            now = monotonic()
+            if now < deadline:
+                if wait is None: time.sleep(deadline - now)
+                else: wait(deadline - now)
+                now = monotonic()
+            elif late == "drop" and now >= deadline + interval:
+                frame_stats["dropped"] += 1
+                i = i + 1
+                continue
+            frame_number, frame_lateness = i, now - deadline
+            if period: frame_fn(i % period)
+            else: frame_fn(i)
+            if profiling: profile_time("frame", monotonic() - now)
+            # jitter is how late a frame was started
+            jitter = now - deadline
+            frame_stats["shown"] += 1
+            frame_stats["jitter_sum"] += jitter
+            frame_stats["jitter_sqsum"] += jitter*jitter
+            frame_stats["jitter_max"] = max(frame_stats["jitter_max"], jitter)
+            # a frame is late if it took longer than its time slot
+            if monotonic() > deadline + interval:
+                frame_stats["late"] += 1
+            i = i + 1
+    finally:
+        # the last frame is shown until the end of its time slot
+        frame_stats["end"] = max(monotonic(), start + i*interval)
+        frame_number, frame_lateness = -1, 0.0
+
+def print_frame_stats():
+    "Print a summary of the frames shown by the last call to `animate()`."
+    global frame_stats
+    n = frame_stats["shown"]
+    if n == 0: return
+    duration = frame_stats["end"] - frame_stats["start"]
+    mean = frame_stats["jitter_sum"] / n
+    sd = max(0, frame_stats["jitter_sqsum"] / n - mean*mean) ** 0.5
+    print "Frames shown: %d, dropped: %d, late: %d" % \
+        (n, frame_stats["dropped"], frame_stats["late"])
+    print "Delivered framerate: %.2f fps over %.2f s" % (n/duration, duration)
+    print "Jitter: mean %.3f ms, sd %.3f ms, max %.3f ms" % \
+        (mean*1000, sd*1000, frame_stats["jitter_max"]*1000)
+
+## STIMULUS PLAYER
+## A stimulus can also be written as a generator that draws each frame and
+## then yields, instead of a frame function. It may yield None (render the
+## frame drawn in the buffer, so only the panels that changed are sent) or a
+## list of (pin mask, data) updates to send as they are (e.g. read from a
+## cache file). `play()` runs the generator on a worker thread that stays a
+## few frames ahead of the panels: each frame is rendered into a bounded queue
+## (capturing the updates with `sink`), and the main thread only sends the
+## next queued frame at its deadline, so the time a frame takes to draw does
+## not delay it (unless drawing falls behind for longer than the queue). The
+## worker never draws more frames than will be shown, so when `play()`
+## returns, the buffer holds the frame the panels show.
+
+def prefetch_worker(stimulus, frames, stop, ticks, drawn):
+    '''
+    Draw the frames of a stimulus (at most ticks, unless -1) and put their
+    updates in the queue frames (see above), followed by None when it ends,
+    or the exception it raised. drawn[0] counts the frames drawn.
+    '''
+    global sink
+    captured = []
+    def put(item):
+        # the player may stop while the queue is full
+        while not stop.is_set():
+            try:
+                frames.put(item, timeout=0.05)
+                return
+            except Queue.Full:
+                pass
+    try:
+        sink = captured.extend
+        if drawn[0] == ticks: return
+        for item in stimulus:
+            if stop.is_set(): return
+            if item is None: render()
+            else: captured.extend(item)
+            drawn[0] += 1
+            put(captured[:])
+            del captured[:]
+            # (the player stops by itself after the last frame)
+            if drawn[0] == ticks: return
+        put(None)
+    except Exception as e:
+        put(e)
+
+def play(stimulus, fps, ticks=-1, prefetch=4):
+    '''
+    Show the frames of a stimulus generator (see above) at a fixed framerate,
+    until it ends or after ticks frames (-1 -> forever). Frames are never
+    dropped, as they may only contain the panels that changed.
+    prefetch: The number of frames drawn ahead (0 -> draw each frame at its
+              deadline, as `animate()` does)
+    If `sink` is set (e.g. by daemon.py or network.py), the frames' updates
+    are passed to it as raw updates (`sink(updates, True)`). In TEXT mode, the
+    frames are drawn at their deadlines.
+    '''
+    global MODE, sink, shown, changed_panels, npanels, output_thread
+    global output_queue, frame_logging, frame_number, frame_lateness
+    global render_count
+    if MODE == "TEXT": prefetch = 0
+    if prefetch <= 0:
+        def frame(t):
+            item = next(stimulus)
+            if item is None: render()
+            elif sink is not None: sink(item, True)
+            elif MODE == "TEXT":
+                raise Exception("Cannot show raw updates in TEXT mode.")
+            else:
+                for mask, data in item: output(mask, data)
+        try:
+            animate(frame, fps, ticks, late="render")
+        except StopIteration:
+            pass
+        return
+    wait() # don't interfere with frames that are still being sent
+    # the first frame updates every panel, as the worker can't know what the
+    # panels show when it is sent
+    shown = [None] * len(pins)
+    target = sink
+    frames, stop = Queue.Queue(prefetch), threading.Event()
+    drawn, sent = [0], [0]
+    worker = threading.Thread(target=prefetch_worker,
+                              args=(stimulus, frames, stop, ticks, drawn))
+    worker.daemon = True
+    def frame(t):
+        updates = frames.get()
+        if updates is None: raise StopIteration()
+        elif isinstance(updates, Exception): raise updates
+        if frame_logging: info = (frame_number, render_count, frame_lateness)
+        else: info = None
+        if target is not None: target(updates, True)
+        elif output_thread is not None:
+            check_output_thread()
+            output_queue.put((updates, info))
+        else:
+            for mask, data in updates: output(mask, data, info)
+        sent[0] += 1
+    try:
+        worker.start()
+        # start once the queue is full, so that the first frames are on time
+        while frames.qsize() < prefetch and worker.is_alive():
+            time.sleep(0.001)
+        animate(frame, fps, ticks, late="render")
+    except StopIteration:
+        pass
+    finally:
+        stop.set()
+        worker.join()
+        sink = target
+        if hasattr(stimulus, "close"): stimulus.close()
+        if drawn[0] != sent[0]:
+            # frames drawn ahead were not shown (e.g. after an error), so the
+            # next render sends the buffer as it is now
+            shown = [None] * len(pins)
+            changed_panels = [True] * npanels
+
+## PROFILING
+## When profiling is on, the time spent in each stage of drawing and output
+## is recorded (per panel for the output stages), keeping the most recent
+## `profile_window` measurements of each. When it is off, the only cost is
+## checking the `profiling` flag, so the hooks can stay in place on the arenas.
+## Stages: "shape" (building shapes), "draw" (plotting them), "compose"
+## (repainting layers), "render" (collecting panel updates), "gpio" and "show"
+## (the pin changes and strip transfers of each update), "frame" (a whole
+## frame in `animate()`)
+global profiling, profile, profile_window, profile_file
+profiling = False
+profile = {}
+profile_window = 1000
+profile_file = None
+
+## The upper bounds in milliseconds of the histogram bins
+global profile_bins
+profile_bins = (0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50,
+                float("inf"))
+
+def set_profiling(enabled=True, window=1000, csv_file=None):
+    '''
+    Turn profiling on or off (discarding previous measurements).
+    window: The number of measurements to keep per stage and panel
+    csv_file: If given, `run()` writes the profile to this file at the end
+    '''
+    global profiling, profile, profile_window, profile_file
+    profile = {}
+    profile_window = window
+    profile_file = csv_file
+    profiling = enabled
+
+def profile_time(stage, seconds, mask=None):
+    '''
+    Record the duration of a stage. If a panel mask is given, the measurement
+    is recorded for each panel whose bit is set (bit i stands for panel i).
+    '''
+    global profile, profile_window, pins
+    if mask is None: panels = ("all",)
+    else: panels = [i for i in range(len(pins)) if mask >> i & 1]
+    for p in panels:
+        key = (stage, p)
+        if key not in profile:
+            profile[key] = collections.deque(maxlen=profile_window)
+        profile[key].append(seconds)
+
+def profile_summary():
+    '''
+    Summarise the profile as a list of rows (stage, panel, count, mean, median,
+    95th percentile, maximum, histogram counts per bin), times in milliseconds.
+    '''
+    global profile, profile_bins
+    order = ["shape", "draw", "compose", "render", "gpio", "show", "frame"]
+    def sort_key(key):
+        if key[0] in order: return (order.index(key[0]), str(key[1]))
+        else: return (len(order), key)
+    rows = []
+    for key in sorted(profile.keys(), key=sort_key):
+        times = sorted(t*1000 for t in profile[key])
+        n = len(times)
+        if n == 0: continue
+        hist = [0] * len(profile_bins)
+        b = 0
+        for t in times:
+            while t > profile_bins[b]: b = b + 1
+            hist[b] += 1
+        rows.append([key[0], key[1], n, sum(times)/n, times[n//2],
+                     times[min(n-1, int(n*0.95))], times[-1]] + hist)
+    return rows
+
+def print_profile():
+    "Print the time spent in each stage, with a histogram of the durations."
+    global profile_bins
+    rows = profile_summary()
+    if not rows: return
+    print "%-8s %5s %6s %9s %9s %9s %9s  histogram (ms)" % \
+        ("stage", "panel", "n", "mean", "median", "95%", "max")
+    for row in rows:
+        hist = " ".join("%g:%d" % (b, c) for b, c in
+                        zip(profile_bins, row[7:]) if c > 0)
+        print "%-8s %5s %6d %9.3f %9.3f %9.3f %9.3f  %s" % \
+            (tuple(row[:7]) + (hist,))
+
+def write_profile(path):
+    "Write the profile summary to a CSV file."
+    global profile_bins
+    out = open(path, "w")
+    try:
+        out.write(",".join(["stage", "panel", "n", "mean_ms", "median_ms",
+                            "p95_ms", "max_ms"] +
+                           ["le_%g_ms" % b for b in profile_bins]) + "\n")
+        for row in profile_summary():
+            out.write(",".join(str(v) for v in row) + "\n")
+    finally:
+        out.close()
+
+## FRAME LOG
+## When the frame log is on, each update sent to the panels is recorded as a
+## fixed-size record in a preallocated ring buffer: the time `strip.show()`
+## returned (`monotonic()`), the frame number in `animate()` (-1 outside of
+## it), the number of `render()` calls so far, a CRC32 of the panel data
+## (before any brightness correction), how late `animate()` started the frame
+## (in seconds), and the panel mask. A background thread writes the records to
+## a binary file (read it with framelog.py), so that logging only costs a few
+## microseconds per update.
+global frame_logging, log_record, log_magic, log_version
+frame_logging = False
+log_record = struct.Struct("<diIIfB3x")
+log_magic, log_version = "MAFL", 1
+
+## The current frame number and lateness in `animate()`, and the number of
+## `render()` calls
+global frame_number, frame_lateness, render_count
+frame_number, frame_lateness, render_count = -1, 0.0, 0
+
+## The ring buffer, the number of records written to it, flushed to the file
+## and lost (because the buffer was full), the file, and the flush thread
+global log_ring, log_capacity, log_written, log_flushed, log_lost
+global log_file, log_thread, log_stop, log_lock
+log_ring, log_capacity = None, 0
+log_written, log_flushed, log_lost = 0, 0, 0
+log_file, log_thread, log_stop = None, None, None
+log_lock = threading.Lock()
+
+def log_update(mask, digest, info=None):
+    "Add a record to the frame log (see above)."
+    global log_ring, log_capacity, log_written, log_record
+    global frame_number, frame_lateness, render_count
+    if info is None: info = (frame_number, render_count, frame_lateness)
+    log_record.pack_into(log_ring, (log_written % log_capacity) *
+                         log_record.size, monotonic(), info[0], info[1],
+                         digest & 0xFFFFFFFF, info[2], mask)
+    log_written += 1
+
+def flush_frame_log():
+    "Write the records added since the last flush to the log file."
+    global log_ring, log_capacity, log_written, log_flushed, log_lost
+    global log_file, log_lock, log_record
+    with log_lock:
+        end = log_written
+        # records that were overwritten before they could be written are lost
+        # (as is the oldest one, whose slot the next record may be written to
+        # while copying)
+        start = max(log_flushed, end - log_capacity + 1)
+        if start >= end: return
+        size = log_record.size
+        first, last = start % log_capacity, end % log_capacity
+        if first < last: data = bytes(log_ring[first*size:last*size])
+        else: data = bytes(log_ring[first*size:] + log_ring[:last*size])
+        # (more records may have been overwritten while copying, and the
+        # oldest one left may be half overwritten)
+        overwritten = min(log_written - log_capacity + 1, end) - start
+        if overwritten > 0:
+            data = data[overwritten*size:]
+            start = start + overwritten
+        log_lost += start - log_flushed
+        log_file.write(data)
+        log_flushed = end
+
+def flush_worker(interval):
+    "Flush the frame log every interval seconds, until `log_stop` is set."
+    global log_stop
+    while not log_stop.wait(interval):
+        flush_frame_log()
+
+def set_frame_log(path=None, capacity=65536, interval=0.5):
+    '''
+    Start logging every update sent to the panels to a binary file (see above),
+    or stop logging (and write the rest of the log) if path is None.
+    capacity: The number of records the ring buffer holds
+    interval: How often (in seconds) the records are written to the file
+    '''
+    global frame_logging, log_ring, log_capacity, log_written, log_flushed
+    global log_lost, log_file, log_thread, log_stop, log_record
+    global log_magic, log_version
+    if log_thread is not None:
+        wait() # (the output thread may still log updates)
+        frame_logging = False
+        log_stop.set()
+        log_thread.join()
+        log_thread = None
+        try:
+            flush_frame_log()
+        finally:
+            log_file.close()
+        if log_lost > 0:
+            print "Frame log: %d records lost (the buffer was too small)" % \
+                log_lost
+    if path is None: return
+    log_ring = bytearray(capacity * log_record.size)
+    log_capacity = capacity
+    log_written, log_flushed, log_lost = 0, 0, 0
+    log_file = open(path, "wb")
+    log_file.write(struct.pack("<4sBH", log_magic, log_version,
+                               log_record.size))
+    log_stop = threading.Event()
+    log_thread = threading.Thread(target=flush_worker, args=(interval,))
+    log_thread.daemon = True
+    log_thread.start()
+    frame_logging = True
 
 ## UTILITY FUNCTIONS
                 
@@ -191,31 +1287,56 @@ def set_mode(new_mode):
     Call this instead of setting MODE directly!
     Even better, use `arena.run()` instead.
     '''
-    global MODE
+    global MODE, height, width, hardware_ready
     if new_mode not in ("TEXT", "SERIAL", "PARALLEL", "DUPLICATE"):
         raise Exception("Invalid mode "+new_mode)
     else:
+        wait()
+        geometry = (height, width)
         MODE = new_mode
-        init_GPIO()
+        init_panels()
         init_dimensions()
+        if (height, width) != geometry: init_pixel_map()
         init_arena()
+        clear_layers()
+        # the pins are set up for the new mode when the next update is sent
+        hardware_ready = False
 
 def toggle_panel(panel, value=None):
     '''
     Turn a panel (0-7) on or off. (value == True -> on, value == False -> off,
     value == None -> toggle). Can only be used in DUPLICATE mode!
     '''
-    global MODE, pins
+    global MODE, pins, panel_on, pin_mask, output_thread, hardware_ready, sink
     if MODE != "DUPLICATE":
         raise Exception("Can only toggle panels in DUPLICATE mode.")
     if value == None:
-        value = not bool(GPIO.input(panel))
-    elif value == True:
-        value = GPIO.HIGH
-    elif value == False:
-        value = GPIO.LOW
-    else: raise Exception("Invalid toggle value "+str(value))
-    GPIO.output(pins[panel], value)
+        value = not panel_on[panel]
+    elif value != True and value != False:
+        raise Exception("Invalid toggle value "+str(value))
+    panel_on[panel] = bool(value)
+    # when double buffering, the output thread switches the pins as needed,
+    # and a sink gets the panels with each update
+    if output_thread is not None or sink is not None: return
+    if not hardware_ready: init_hardware()
+    if value: set_pins(pin_mask | 1 << panel)
+    else: set_pins(pin_mask & ~(1 << panel))
+
+def set_panels(mask):
+    '''
+    Turn on the panels whose bits are set in mask (bit i stands for panel i),
+    and turn off all others, in a single operation (much faster than calling
+    `toggle_panel()` for each). Can only be used in DUPLICATE mode!
+    '''
+    global MODE, pins, panel_on, output_thread, hardware_ready, sink
+    if MODE != "DUPLICATE":
+        raise Exception("Can only toggle panels in DUPLICATE mode.")
+    panel_on = [bool(mask >> i & 1) for i in range(len(pins))]
+    # when double buffering, the output thread switches the pins as needed,
+    # and a sink gets the panels with each update
+    if output_thread is not None or sink is not None: return
+    if not hardware_ready: init_hardware()
+    set_pins(mask)
         
 def run(display_fn, mode=None):
     '''
@@ -223,6 +1344,7 @@ def run(display_fn, mode=None):
     display_fn: A function object to execute (no arguments accepted).
     mode: The mode to switch to before execution.
     '''
+    global profiling, profile_file, hardware_ready
     if mode is not None: set_mode(mode)
     try:
         display_fn()
@@ -231,7 +1353,17 @@ def run(display_fn, mode=None):
     except Exception as e:
         print "Error:", e
     finally:
+        try:
+            set_double_buffer(False)
+            set_frame_log(None)
+        except Exception as e:
+            print "Error:", e
+        print_frame_stats()
+        if profiling:
+            print_profile()
+            if profile_file: write_profile(profile_file)
         GPIO.cleanup()
+        hardware_ready = False
         
 def parseArgs():
     '''
@@ -0,0 +1,759 @@
+#!/usr/bin/python2
+### Benchmarks for the arena library.
+###
+### These can be run on a development machine (using the mockup hardware
+### modules) or on the Pi itself, to check how much CPU time the drawing and
+### rendering functions need per frame. On a development machine, the
+### `scripts` benchmark simulates the transfer times of the real hardware to
+### estimate the framerates that the scripts can achieve in each mode.
+###
+### Usage: './benchmark.py [name ...]', where <name> selects the benchmarks
+### to run (e.g. 'pixel_map'). Without arguments, all benchmarks are run.
+###
+### Licensed under the terms of the GNU GPLv3
+
+import sys, time
+import arena, shape
+
+### HELPER FUNCTIONS ###
+
+def measure(fn, n=100):
+    "Return the mean CPU time in milliseconds needed for one call of fn."
+    start = time.clock()
+    for i in range(n): fn()
+    return (time.clock() - start) * 1000.0 / n
+
+def report(name, ms, baseline=None):
+    "Print the result of a measurement, optionally compared to a baseline."
+    line = "  %-44s %9.3f ms" % (name, ms)
+    if baseline: line = line + "  (x%.1f)" % (baseline / ms)
+    print(line)
+
+### BENCHMARKS ###
+
+def bench_pixel_map():
+    "Addressing every pixel of a frame via pixel_id() vs. lookup tables"
+    arena.set_mode("PARALLEL")
+    arena.init_hardware() # the legacy loop uses the strip directly
+    height, pwidth, npanels = arena.height, arena.pwidth, arena.npanels
+    legacy_colours = dict((c, (i, arena.colours[c][1]))
+                          for i, c in enumerate(arena.colours))
+    names = ["green"] * height * arena.width
+    def legacy_render():
+        # the per-pixel loop that render() used before the packed buffer
+        for p in range(npanels):
+            for y in range(height):
+                for x in range(pwidth):
+                    pid = arena.pixel_id(x+(p*pwidth), y)
+                    col = legacy_colours[names[pid]][0]
+                    spid = pid - (p*pwidth*height)
+                    arena.strip.setPixelColor(spid, col)
+            arena.strip.show()
+    def legacy_set_frame():
+        for x in range(arena.width):
+            for y in range(height):
+                pid = arena.pixel_id(x, y)
+                arena.arena[pid*4:pid*4+4] = arena.colours["green"][0]
+                arena.changed_panels[pid/(pwidth*height)] = True
+    def set_frame():
+        for x in range(arena.width):
+            for y in range(height):
+                arena.set_pixel(x, y, "green")
+    def render():
+        arena.changed_panels = [True] * npanels
+        arena.shown = [None] * len(arena.pins) # force a full push
+        arena.render()
+    base = measure(legacy_render, 20)
+    report("render, per-pixel pixel_id()", base)
+    report("render, packed buffer", measure(render), base)
+    base = measure(legacy_set_frame, 20)
+    report("set all pixels, pixel_id()", base)
+    report("set all pixels, pixel_map", measure(set_frame, 20), base)
+
+def bench_panel_skipping():
+    "Panel updates pushed vs. skipped as unchanged, for the landscape animation"
+    import landscape
+    arena.set_mode("PARALLEL")
+    arena.render_stats.update(pushed=0, skipped=0)
+    frames = 100
+    for t in range(frames):
+        landscape.draw_frame(t)
+        arena.render()
+    pushed, skipped = arena.render_stats["pushed"], arena.render_stats["skipped"]
+    print("  %d frames: %d panels pushed, %d skipped (%.1f pushes/frame)"
+          % (frames, pushed, skipped, float(pushed)/frames))
+
+def bench_coalescing():
+    "SPI transfers per frame for the optic flow bar pattern in PARALLEL mode"
+    import optic_flow
+    arena.set_mode("PARALLEL")
+    arena.render_stats.update(pushed=0, skipped=0, transfers=0)
+    frames = 100
+    for t in range(frames):
+        for p in range(arena.npanels):
+            optic_flow.panel_pattern(t + p*arena.pwidth)
+        arena.render()
+    print("  %d frames: %.1f panel updates/frame in %.1f transfers/frame"
+          % (frames, float(arena.render_stats["pushed"])/frames,
+             float(arena.render_stats["transfers"])/frames))
+
+def bench_framecache():
+    "CPU time per frame of the landscape animation, live vs. from a cache file"
+    import tempfile, shutil, framecache, landscape
+    arena.set_mode("PARALLEL")
+    frames = arena.width
+    framecache.cache_dir = tempfile.mkdtemp()
+    path = framecache.cached("landscape", {}, landscape.draw_frame, frames)
+    def live():
+        for t in range(frames):
+            landscape.draw_frame(t)
+            arena.render()
+    def replay():
+        framecache.play(path, 1000000, frames)
+    base = measure(live, 5) / frames
+    report("draw and render live", base)
+    report("replay from cache file", measure(replay, 5) / frames, base)
+    shutil.rmtree(framecache.cache_dir)
+
+def bench_double_buffer():
+    "Time per draw-heavy frame with simulated transfers, with/without a thread"
+    import dotstar, landscape
+    arena.set_mode("PARALLEL")
+    # a 16x16 panel takes about 0.8ms to send at 10MHz
+    dotstar.Adafruit_DotStar.simulate = True
+    frames = 50
+    def background():
+        # drawn pixel by pixel, so that drawing a frame takes about as long
+        # as sending it
+        for i in range(4):
+            for x in range(arena.width):
+                for y in range(arena.height): arena.set_pixel(x, y, "blue")
+        landscape.draw_panorama()
+    def draw(t):
+        arena.clear_layers()
+        arena.set_background(background)
+        landscape.draw_frame(t)
+    def run(send=True):
+        for t in range(frames):
+            draw(t)
+            if not send: continue
+            # send every panel
+            arena.shown = [None] * len(arena.pins)
+            arena.changed_panels = [True] * arena.npanels
+            arena.render()
+        arena.wait()
+    def timed(fn, *args):
+        start = time.time()
+        fn(*args)
+        return (time.time() - start) * 1000.0 / frames
+    try:
+        report("drawing only", timed(run, False))
+        report("sending only (8 panels)", arena.transfer_time() * 8 * 1000)
+        base = timed(run)
+        report("synchronous render", base)
+        arena.set_double_buffer(True)
+        report("double buffered render", timed(run), base)
+    finally:
+        arena.set_double_buffer(False)
+        dotstar.Adafruit_DotStar.simulate = False
+
+def bench_fill():
+    "Filling the house and landscape shapes, scanline vs. the old fill_shape()"
+    # the corners of the polygons drawn by house.py and landscape.py
+    polygons = [((24,15), (72,15), (72,7), (24,7)),
+                ((20,7), (24,3), (72,3), (76,7)),
+                ((58,15), (58,10), (64,10), (64,15)),
+                ((32,9), (44,9), (44,12), (32,12)),
+                ((98,11), (100,11), (100,15), (98,15)),
+                ((0,14), (10,8), (20,14)),
+                ((64,14), (69,5), (74,14))]
+    def legacy():
+        for corners in polygons:
+            shape.fill_shape(shape.polygon(corners, filled=False))
+    def scanline():
+        for corners in polygons:
+            shape.polygon(corners)
+    size = shape.cache_size
+    try:
+        shape.cache_size = 0 # rasterize the shapes every time
+        base = measure(legacy, 20)
+        report("fill_shape()", base)
+        report("scanline spans", measure(scanline, 20), base)
+    finally:
+        shape.cache_size = size
+
+def bench_bulk():
+    "Drawing the optic flow bar pattern and landscape hills, per pixel vs. bulk"
+    arena.set_mode("DUPLICATE")
+    def bars_per_pixel():
+        col = "green"
+        for x in range(arena.pwidth):
+            for c in shape.vline(x):
+                arena.set_pixel(c[0], c[1], col)
+            if x == 3 or x == 11: col = "black"
+            elif x == 7: col = "green"
+    def bars_columns():
+        for x in range(0, arena.pwidth, 4):
+            if x % 8 == 0: arena.fill_columns(x, x+3, "green")
+            else: arena.fill_columns(x, x+3, "black")
+    base = measure(bars_per_pixel)
+    report("bar pattern, set_pixel()", base)
+    report("bar pattern, fill_columns()", measure(bars_columns), base)
+    arena.set_mode("PARALLEL")
+    hills = shape.triangle(0, 14, 10, 8, 20, 14) + \
+            shape.triangle(64, 14, 69, 5, 74, 14)
+    hill_spans = shape.triangle(0, 14, 10, 8, 20, 14, spans=True) + \
+                 shape.triangle(64, 14, 69, 5, 74, 14, spans=True)
+    def hills_per_pixel():
+        for c in hills: arena.set_pixel(c[0], c[1], "magenta")
+    base = measure(hills_per_pixel)
+    report("hills, set_pixel()", base)
+    report("hills, set_pixels()",
+           measure(lambda: arena.set_pixels(hills, "magenta")), base)
+    report("hills, fill_spans()",
+           measure(lambda: arena.fill_spans(hill_spans, "magenta")), base)
+    try:
+        import numpy
+    except ImportError:
+        return
+    points = numpy.array(hills)
+    mask = numpy.zeros((arena.height, arena.width), bool)
+    mask[points[:,1], points[:,0]] = True
+    report("hills, set_pixels() on a NumPy array",
+           measure(lambda: arena.set_pixels(points, "magenta")), base)
+    report("hills, set_mask() on a list",
+           measure(lambda: arena.set_mask(mask.ravel().tolist(), "magenta")),
+           base)
+    report("hills, set_mask() on a NumPy mask",
+           measure(lambda: arena.set_mask(mask, "magenta")), base)
+
+def bench_shape_cache():
+    "Building the landscape shapes each frame, with and without the shape cache"
+    import landscape
+    arena.set_mode("PARALLEL")
+    def frames():
+        for t in range(arena.width):
+            landscape.draw_panorama()
+            shape.plot(shape.line(64-t, 3, 64-t, 9), "black")
+            arena.set_pixel(t, 6, "green")
+    size = shape.cache_size
+    try:
+        shape.cache_size = 0
+        base = measure(frames, 5) / arena.width
+        report("draw frame, no cache", base)
+        shape.cache_size = size
+        shape.clear_cache()
+        report("draw frame, cache", measure(frames, 5) / arena.width, base)
+        print("  cache hits: %(hits)d, misses: %(misses)d" % shape.cache_stats)
+    finally:
+        shape.cache_size = size
+
+def bench_layers():
+    "Landscape frames redrawn from scratch vs. composed from layers"
+    import landscape
+    arena.set_mode("PARALLEL")
+    def redraw():
+        for t in range(arena.width):
+            landscape.draw_panorama()
+            shape.plot(shape.line(64-t, 3, 64-t, 9), "black")
+            arena.set_pixel(t, 6, "green")
+            arena.render()
+    def layers():
+        for t in range(arena.width):
+            landscape.draw_frame(t)
+            arena.render()
+    base = measure(redraw, 5) / arena.width
+    report("redraw and render", base)
+    arena.render_stats.update(pushed=0, skipped=0)
+    report("compose and render", measure(layers, 5) / arena.width, base)
+    print("  %.1f panels changed/frame"
+          % (float(arena.render_stats["pushed"] + arena.render_stats["skipped"])
+             / (5*arena.width)))
+
+def bench_scroll():
+    "Rotating the optic flow bars and the landscape, redrawn vs. scrolled"
+    import optic_flow
+    arena.set_mode("DUPLICATE")
+    state = {"t": 0}
+    def bars_redraw():
+        state["t"] += 1
+        optic_flow.panel_pattern(state["t"])
+    base = measure(bars_redraw)
+    report("bar pattern, redraw", base)
+    report("bar pattern, scroll()", measure(lambda: arena.scroll(1)), base)
+    arena.set_mode("PARALLEL")
+    panorama = shape.line(0,15,127,15, spans=True) + \
+               shape.triangle(0, 14, 10, 8, 20, 14, spans=True) + \
+               shape.triangle(64, 14, 69, 5, 74, 14, spans=True)
+    def landscape_redraw():
+        state["t"] += 1
+        arena.clear("blue", show=False)
+        shape.plot_spans(panorama, "magenta", dx=state["t"])
+    base = measure(landscape_redraw)
+    report("landscape, redraw", base)
+    report("landscape, scroll()", measure(lambda: arena.scroll(1)), base)
+    def bands():
+        arena.scroll(1, 0, y1=0, y2=7)
+        arena.scroll(-1, 0, y1=8, y2=15)
+    report("landscape, counter-rotating bands", measure(bands), base)
+
+def bench_scripts():
+    "Framerate, CPU time and bus load of the scripts on simulated hardware"
+    import dotstar, RPi.GPIO, house, landscape, dot_bar, optic_flow
+    def render(draw_fn):
+        def frame(t):
+            draw_fn(t)
+            arena.render()
+        return frame
+    # script name, frame function, modes it can run in
+    scripts = [("house", lambda t: house.draw_house(),
+                ("SERIAL", "PARALLEL", "DUPLICATE")),
+               ("landscape", render(landscape.draw_frame),
+                ("SERIAL", "PARALLEL", "DUPLICATE")),
+               ("dot_bar", render(lambda t: dot_bar.draw_frame(t % arena.width)),
+                ("SERIAL", "PARALLEL", "DUPLICATE")),
+               ("rotate", lambda t: optic_flow.rotate_frame(t % 8),
+                ("DUPLICATE",)),
+               ("flow", lambda t: optic_flow.flow_frame(t % 8),
+                ("DUPLICATE",))]
+    frames = 64
+    strip, log = dotstar.Adafruit_DotStar, dotstar.Adafruit_DotStar.log
+    print("  %-10s %-9s %8s %10s %6s %10s %8s" % ("mode", "script", "fps",
+          "CPU/frame", "bus", "transfers", "panels"))
+    try:
+        strip.simulate, strip.record = True, True
+        RPi.GPIO.simulate = True
+        for mode in ("SERIAL", "PARALLEL", "DUPLICATE"):
+            arena.set_mode(mode)
+            for name, frame_fn, modes in scripts:
+                if mode not in modes: continue
+                del log[:]
+                start, cpu_start = time.time(), time.clock()
+                for t in range(frames): frame_fn(t)
+                arena.wait()
+                wall = time.time() - start
+                cpu = time.clock() - cpu_start
+                # how long the bus was busy, and how many panels each
+                # transfer went to
+                busy = sum(entry[3] for entry in log)
+                panels = sum(len(set(entry[1]) & set(arena.pins))
+                             for entry in log)
+                print("  %-10s %-9s %8.1f %7.3f ms %5.1f%% %10.2f %8.2f"
+                      % (mode, name, frames / wall, cpu * 1000.0 / frames,
+                         busy * 100.0 / wall, float(len(log)) / frames,
+                         float(panels) / max(len(log), 1)))
+    finally:
+        strip.simulate, strip.record = False, False
+        RPi.GPIO.simulate = False
+        del log[:]
+
+def bench_profiling():
+    "Overhead of the profiling hooks on landscape frames, off vs. on"
+    import landscape
+    arena.set_mode("PARALLEL")
+    def frames():
+        for t in range(arena.width):
+            landscape.draw_frame(t)
+            arena.render()
+    try:
+        base = measure(frames, 5) / arena.width
+        report("profiling off", base)
+        arena.set_profiling(True)
+        report("profiling on", measure(frames, 5) / arena.width, base)
+    finally:
+        arena.set_profiling(False)
+
+def bench_terminal():
+    "Landscape frames in TEXT mode, ASCII vs. redrawing only changed pixels"
+    import StringIO, landscape
+    arena.set_mode("TEXT")
+    state = {"t": 0}
+    def legacy():
+        # the per-character loop that print_arena() used before
+        for y in range(arena.height):
+            for x in range(arena.width):
+                sys.stdout.write(arena.colours[arena.pixel(x,y)][1])
+            sys.stdout.write('\n')
+            sys.stdout.flush()
+    def frame(print_fn):
+        def draw():
+            landscape.draw_frame(state["t"] % arena.width)
+            arena.compose()
+            print_fn()
+            state["t"] += 1
+        return draw
+    out = StringIO.StringIO()
+    try:
+        sys.stdout = out
+        base = measure(frame(legacy), 50)
+        plain = measure(frame(arena.print_arena), 50)
+        arena.terminal_shown = None
+        out.truncate(0)
+        ansi = measure(frame(arena.print_terminal), 50)
+    finally:
+        sys.stdout = sys.__stdout__
+    report("ASCII, one write per pixel", base)
+    report("ASCII, one write per frame", plain, base)
+    report("ANSI colour, changed pixels only", ansi, base)
+    print("  %.0f bytes/frame written to the terminal" % (len(out.getvalue())/50.0))
+
+def bench_colours():
+    "Drawing an intensity ramp (with gamma), and sending it with a brightness"
+    arena.set_mode("PARALLEL")
+    ramp = [(x*2, x*2, x*2) for x in range(arena.width)]
+    def named():
+        for x in range(arena.width):
+            arena.fill_columns(x, x, "green")
+    def graded():
+        for x in range(arena.width):
+            arena.fill_columns(x, x, ramp[x])
+    base = measure(named)
+    report("columns, named colour", base)
+    report("columns, RGB ramp", measure(graded), base)
+    try:
+        arena.set_brightness(1.0, 2.2)
+        report("columns, RGB ramp with gamma", measure(graded), base)
+    finally:
+        arena.set_brightness()
+    def push():
+        arena.shown = [None] * len(arena.pins) # send every panel
+        arena.changed_panels = [True] * arena.npanels
+        arena.render()
+    try:
+        base = measure(push)
+        report("render, no correction", base)
+        arena.set_brightness(0.5)
+        report("render, global brightness", measure(push), base)
+    finally:
+        arena.set_brightness()
+
+def bench_startup():
+    "Time to start a script: importing the modules and setting the mode"
+    import os, subprocess
+    here = os.path.dirname(os.path.abspath(__file__))
+    def start(code):
+        def run():
+            subprocess.check_call([sys.executable, "-c", code], cwd=here)
+        return run
+    def wall(fn, n=10):
+        start = time.time()
+        for i in range(n): fn()
+        return (time.time() - start) * 1000.0 / n
+    base = wall(start("pass"))
+    report("python interpreter", base)
+    report("import arena, shape",
+           wall(start("import arena, shape")) - base)
+    report("import, then set_mode()",
+           wall(start("import arena, shape; arena.set_mode('PARALLEL')")) - base)
+    report("import, set_mode(), first render()",
+           wall(start("import arena, shape; arena.set_mode('PARALLEL'); "
+                      "arena.clear()")) - base)
+    arena.set_mode("PARALLEL")
+    report("switch PARALLEL -> SERIAL -> PARALLEL",
+           measure(lambda: (arena.set_mode("SERIAL"),
+                            arena.set_mode("PARALLEL"))))
+
+def bench_daemon():
+    "Landscape frames rendered locally vs. through the arena daemon"
+    import os, subprocess, tempfile, shutil, landscape, daemon
+    here = os.path.dirname(os.path.abspath(__file__))
+    tmp = tempfile.mkdtemp()
+    daemon.socket_file = os.path.join(tmp, "arena.sock")
+    daemon.shm_file = os.path.join(tmp, "arena.shm")
+    server = subprocess.Popen([sys.executable, "-c",
+        "import arena, daemon; daemon.socket_file, daemon.shm_file = %r, %r; "
+        "arena.run(daemon.serve, 'PARALLEL')"
+        % (daemon.socket_file, daemon.shm_file)], cwd=here)
+    try:
+        while not os.path.exists(daemon.socket_file):
+            if server.poll() is not None:
+                raise Exception("The daemon did not start.")
+            time.sleep(0.01)
+        arena.set_mode("PARALLEL")
+        def frames():
+            for t in range(arena.width):
+                landscape.draw_frame(t)
+                arena.render()
+        def wall(fn, n=5):
+            start = time.time()
+            for i in range(n): fn()
+            return (time.time() - start) * 1000.0 / (n * arena.width)
+        base = wall(frames)
+        report("local render", base)
+        daemon.connect()
+        report("render through the daemon", wall(frames), base)
+        start = time.time()
+        for i in range(1000): daemon.command("stats")
+        report("command round trip", (time.time() - start))
+        daemon.command("shutdown")
+    finally:
+        daemon.disconnect()
+        server.wait()
+        shutil.rmtree(tmp)
+
+def bench_network():
+    "Landscape frames streamed to frame servers on loopback"
+    import os, socket, subprocess, landscape, network
+    here = os.path.dirname(os.path.abspath(__file__))
+    ports = [17421 + i for i in range(4)]
+    servers = [subprocess.Popen([sys.executable, "network.py", "PARALLEL",
+                                 str(port)], cwd=here) for port in ports]
+    try:
+        arena.set_mode("PARALLEL")
+        def frames():
+            for t in range(arena.width):
+                landscape.draw_frame(t)
+                arena.render()
+            network.sync()
+        def wall(fn, n=5):
+            start = time.time()
+            for i in range(n): fn()
+            return (time.time() - start) * 1000.0 / (n * arena.width)
+        base = wall(frames)
+        report("local render", base)
+        for n in (1, 2, 4):
+            for port in ports[:n]:
+                while True:
+                    try:
+                        network.connect("localhost", port)
+                        break
+                    except socket.error:
+                        time.sleep(0.05)
+            sent = sum(c["sent"] for c in network.connections)
+            report("render to %d arena(s)" % n, wall(frames), base)
+            sent = sum(c["sent"] for c in network.connections) - sent
+            print("    %.0f bytes per frame and arena (a full frame: %d)" %
+                  (sent / (5.0 * arena.width * n), len(arena.arena)))
+            rows = network.latency_summary()
+            print("    latency: median %.3f ms, 95%% %.3f ms" %
+                  (sum(r[3] for r in rows) / n, sum(r[4] for r in rows) / n))
+            network.disconnect()
+    finally:
+        network.disconnect()
+        for server in servers: server.terminate()
+        for server in servers: server.wait()
+
+def bench_closed_loop():
+    "Latency from tracker sample to panels with a fake 500Hz tracker"
+    import dotstar, RPi.GPIO, closed_loop
+    dotstar.Adafruit_DotStar.simulate = True
+    RPi.GPIO.simulate = True
+    try:
+        for mode in ("PARALLEL", "DUPLICATE"):
+            arena.set_mode(mode)
+            for fps in (100, 200):
+                closed_loop.follow("fake", fps, fps)
+                times = sorted((shown - arrived)*1000 for arrived, shown, h, o
+                               in closed_loop.latency_log)
+                n = len(times)
+                report("%s at %d fps, median" % (mode, fps), times[n//2])
+                report("%s at %d fps, 95%%" % (mode, fps),
+                       times[min(n-1, int(n*0.95))])
+    finally:
+        dotstar.Adafruit_DotStar.simulate = False
+        RPi.GPIO.simulate = False
+
+def bench_protocol():
+    "Timing error per trial transition, trial by trial vs. a session"
+    import framecache, protocol
+    trials = [{"stimulus": "landscape", "fps": 100, "frames": 20},
+              {"stimulus": "dot_bar", "fps": 100, "frames": 20},
+              {"stimulus": "blank", "colour": "red", "fps": 100, "frames": 5},
+              {"stimulus": "dot_bar", "direction": -1, "fps": 100,
+               "frames": 20}] * 5
+    session = protocol.compile_session({"mode": "PARALLEL", "trials": trials})
+    # the last frame of the session is shown as soon as it starts, every
+    # other frame for its time slot
+    nominal = sum(s["frames"] / s["fps"] for s in session) - \
+        1.0 / session[-1]["fps"]
+    def error(fn):
+        start = time.time()
+        fn()
+        return abs(time.time() - start - nominal) * 1000.0 / \
+            (len(session) - 1)
+    def trials():
+        for s in session: framecache.play(s["path"], s["fps"], s["frames"])
+    base = error(trials)
+    report("trial by trial", base)
+    report("compiled session",
+           error(lambda: protocol.play_session(session)), base)
+
+def circle_frame(t):
+    "A frame of circles drawn from scratch (slow enough to be worth sharing)."
+    import shape
+    arena.clear("black", show=False)
+    for i in range(8):
+        x = (t + i*16) % arena.width
+        shape.plot_spans(shape.circle_spans(x, 7, 2 + (t+i) % 6),
+                         colour="green")
+        shape.plot_spans(shape.polygon_spans([(x, 0), (x+5, 15), (x-5, 15)]),
+                         colour="red")
+
+def circle_frames():
+    "The circle frame function (for `framecache.compile_parallel()`)."
+    return circle_frame
+
+def bench_offline():
+    "Recording 1024 frames in one process vs. a pool of processes"
+    import os, tempfile, shutil, multiprocessing, framecache
+    arena.set_mode("PARALLEL")
+    nframes = 1024
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, "circles.frames")
+        start = time.time()
+        framecache.compile_animation(circle_frame, nframes, path)
+        base = (time.time() - start) * 1000.0 / nframes
+        report("one process", base)
+        serial = open(path, "rb").read()
+        workers = 1
+        while workers <= max(2, multiprocessing.cpu_count()):
+            start = time.time()
+            framecache.compile_parallel(circle_frames, (), nframes, path,
+                                        workers)
+            report("%d worker(s)" % workers,
+                   (time.time() - start) * 1000.0 / nframes, base)
+            if open(path, "rb").read() != serial:
+                print("    the file differs from the one recorded in order!")
+            for pid in sorted(framecache.worker_stats):
+                frames, seconds = framecache.worker_stats[pid]
+                print("    worker %d: %.1f fps" % (pid, frames / seconds))
+            workers = workers * 2
+    finally:
+        shutil.rmtree(tmp)
+
+def bench_gpio():
+    "GPIO calls per optic_flow frame, toggle_panel() vs. set_panels()"
+    import RPi.GPIO, optic_flow
+    arena.set_mode("DUPLICATE")
+    arena.init_hardware()
+    frames = 800
+    def toggled(t):
+        # the panel selection of optic_flow.flow_frame(), one panel at a time
+        optic_flow.panel_pattern(t)
+        for p in range(8): arena.toggle_panel(p, p < 4)
+        arena.render()
+        optic_flow.panel_pattern(4-t)
+        for p in range(8): arena.toggle_panel(p, p >= 4)
+        arena.render()
+    def run(frame_fn):
+        RPi.GPIO.reset_counts()
+        start = time.time()
+        for t in range(frames): frame_fn(t % 8)
+        ms = (time.time() - start) * 1000.0 / frames
+        return ms, RPi.GPIO.calls / float(frames), \
+            RPi.GPIO.writes / float(frames)
+    RPi.GPIO.simulate = True
+    try:
+        base, calls, writes = run(toggled)
+        report("toggle_panel() for each panel", base)
+        print("    %.1f GPIO calls, %.1f pin writes per frame" %
+              (calls, writes))
+        ms, calls, writes = run(lambda t: optic_flow.flow_frame(t))
+        report("set_panels()", ms, base)
+        print("    %.1f GPIO calls, %.1f pin writes per frame" %
+              (calls, writes))
+    finally:
+        RPi.GPIO.simulate = False
+
+def bench_frame_log():
+    "Cost of an update sent to the panels, without/with the frame log"
+    import os, tempfile
+    arena.set_mode("PARALLEL")
+    arena.init_hardware()
+    data = arena.arena[:arena.pwidth*arena.height*4]
+    n = 20000
+    def run():
+        start = time.time()
+        for i in range(n): arena.output(1 << (i % 8), data)
+        return (time.time() - start) * 1000.0 / n
+    base = run()
+    report("output() without the log", base)
+    path = tempfile.mktemp()
+    try:
+        arena.set_frame_log(path)
+        ms = run()
+        arena.set_frame_log(None)
+        report("output() with the log", ms, base)
+        report("per logged update", ms - base)
+        print("    %d bytes per record" % (os.path.getsize(path) // n))
+    finally:
+        os.remove(path)
+
+def bench_player():
+    "Frame timing with slow frames, frame loop vs. prefetching player"
+    import os, tempfile, dotstar, landscape, framelog
+    dotstar.Adafruit_DotStar.simulate = True
+    arena.set_mode("PARALLEL")
+    fps, frames = 50, 200
+    def background():
+        for i in range(3):
+            for x in range(arena.width):
+                for y in range(arena.height): arena.set_pixel(x, y, "blue")
+        landscape.draw_panorama()
+    def draw(t):
+        # every 10th frame redraws the background pixel by pixel, which takes
+        # several milliseconds longer than the others
+        if t % 10 == 0:
+            arena.clear_layers()
+            arena.set_background(background)
+        landscape.draw_frame(t)
+    def loop():
+        def frame(t):
+            draw(t)
+            arena.render()
+        arena.animate(frame, fps, frames, late="render")
+    def player():
+        def stimulus():
+            t = 0
+            while True:
+                draw(t)
+                yield
+                t = t + 1
+        arena.play(stimulus(), fps, frames)
+    def delays(fn):
+        # how long after its deadline each frame started to reach the panels
+        # (the first update of each frame in the frame log)
+        path = tempfile.mktemp()
+        try:
+            arena.set_frame_log(path)
+            fn()
+            arena.set_frame_log(None)
+            shown = {}
+            for record in framelog.read_log(path):
+                shown.setdefault(record[1], record[0])
+        finally:
+            os.remove(path)
+        start = arena.frame_stats["start"]
+        times = sorted((shown[i] - start - float(i)/fps) * 1000 for i in shown)
+        mean = sum(times) / len(times)
+        sd = (sum((x - mean)**2 for x in times) / len(times)) ** 0.5
+        return sd, times[int(len(times)*0.9)]
+    try:
+        base_sd, base_p90 = delays(loop)
+        sd, p90 = delays(player)
+        report("frame loop, sd of frame delay", base_sd)
+        report("player, sd of frame delay", sd, base_sd)
+        report("frame loop, 90% of frame delays below", base_p90)
+        report("player, 90% of frame delays below", p90, base_p90)
+    finally:
+        dotstar.Adafruit_DotStar.simulate = False
+
+benchmarks = [bench_pixel_map, bench_panel_skipping, bench_coalescing,
+              bench_framecache, bench_double_buffer, bench_fill, bench_bulk,
+              bench_shape_cache, bench_layers, bench_scroll,
+              bench_scripts, bench_profiling, bench_terminal, bench_colours,
+              bench_startup, bench_daemon, bench_network,
+              bench_closed_loop, bench_protocol, bench_offline,
+              bench_gpio, bench_frame_log, bench_player]
+
+def run_benchmarks(names=None):
+    "Run all benchmarks, or only those whose names are given."
+    for b in benchmarks:
+        name = b.__name__[len("bench_"):]
+        if names and name not in names: continue
+        print(name+": "+b.__doc__)
+        b()
+
+if __name__ == '__main__':
+    run_benchmarks(sys.argv[1:])
@@ -0,0 +1,264 @@
+#!/usr/bin/python2
+### Control the LEDs in the ZooII Monarch butterfly arena.
+###
+### Closed-loop stimulus (flight simulator): a pattern of vertical bars is
+### rotated around the arena to follow the butterfly's heading, as measured by
+### a tracker. The tracker's samples are read from a stream while waiting for
+### the next frame, and each frame shows the most recent sample, transformed
+### into a rotation of the pattern by a gain (or any transfer function).
+###
+### Usage: './closed_loop.py <input> [fps] [gain] [mode] [log file]', where
+### <input> is where the tracker samples come from: '-' (stdin), 'host:port'
+### (TCP), the path of a Unix socket, pipe or file, or 'fake' (a simulated
+### tracker for testing).
+###
+### The input is a stream of text lines, each ending with the heading in
+### degrees (so lines like '<timestamp> <heading>' work too). Lines that
+### don't end in a number are ignored.
+###
+### Licensed under the terms of the GNU GPLv3
+
+import os, sys, math, stat, socket, select, threading, collections
+import arena
+
+### SETTINGS ###
+
+## The heading is turned into a rotation of the pattern (in pixels) by
+## `transfer(heading)`, by default gain * heading (one turn of the butterfly
+## rotating the pattern once around the arena for a gain of 1, in the same
+## direction; a negative gain rotates it the other way)
+global gain, transfer
+gain = 1.0
+transfer = None
+
+## Foreground and background colour, and the width of the bars in pixels
+global fg_col, bg_col, bar_width
+fg_col, bg_col = "green", "black"
+bar_width = 4
+
+## The most recent sample: its heading, when it arrived (monotonic clock), and
+## whether it has been shown yet
+global heading, arrival, fresh
+heading, arrival, fresh = 0.0, None, False
+
+## Received text that doesn't form a whole line yet, and the current rotation
+## of the pattern in pixels
+global pending, offset
+pending, offset = "", 0
+
+## Each frame that shows a new sample is logged as (arrival, shown, heading,
+## offset), where shown is when `arena.render()` returned (i.e. after
+## `strip.show()`), keeping the last `log_window` entries
+global latency_log, log_window
+log_window = 10000
+latency_log = collections.deque(maxlen=log_window)
+
+### INPUT ###
+
+## (Sockets are kept here, so they aren't closed while their descriptors are
+## in use)
+global input_socket
+input_socket = None
+
+## The thread of the fake tracker, and the event that stops it
+global tracker, tracker_stop
+tracker, tracker_stop = None, None
+
+def open_input(source):
+    "Open a tracker stream (see above) and return its file descriptor."
+    global input_socket
+    if source == "-":
+        return sys.stdin.fileno()
+    elif source == "fake":
+        return fake_tracker()
+    elif os.path.exists(source):
+        if stat.S_ISSOCK(os.stat(source).st_mode):
+            input_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            input_socket.connect(source)
+            return input_socket.fileno()
+        return os.open(source, os.O_RDONLY)
+    elif ":" in source:
+        host, port = source.rsplit(":", 1)
+        input_socket = socket.create_connection((host, int(port)))
+        return input_socket.fileno()
+    else:
+        raise Exception("Unknown input "+source)
+
+def close_input(fd):
+    "Close a tracker stream opened by `open_input()` (except stdin)."
+    global input_socket, pending, tracker, tracker_stop
+    pending = ""
+    if input_socket is not None:
+        input_socket.close()
+        input_socket = None
+    elif fd != sys.stdin.fileno():
+        os.close(fd)
+    if tracker is not None:
+        # (a write to the closed pipe fails, so the tracker can't block)
+        tracker_stop.set()
+        tracker.join()
+        tracker = None
+
+def fake_tracker(rate=500.0, amplitude=90.0, period=4.0):
+    '''
+    Simulate a tracker that reports a heading swinging back and forth by
+    amplitude degrees every period seconds, rate times a second. Returns the
+    file descriptor to read the samples from.
+    '''
+    global tracker, tracker_stop
+    r, w = os.pipe()
+    stop = threading.Event()
+    def track():
+        start = arena.monotonic()
+        i = 0
+        try:
+            while not stop.is_set():
+                t = i / rate
+                now = arena.monotonic() - start
+                if now < t: arena.time.sleep(t - now)
+                value = amplitude * math.sin(2*math.pi * t / period)
+                os.write(w, "%.3f %.2f\n" % (t, value))
+                i = i + 1
+        except OSError:
+            # the reading end has been closed
+            pass
+        os.close(w)
+    tracker, tracker_stop = threading.Thread(target=track), stop
+    tracker.daemon = True
+    tracker.start()
+    return r
+
+def read_input(fd, timeout=0):
+    '''
+    Wait up to timeout seconds for samples and read all that have arrived.
+    Raises EOFError at the end of the stream.
+    '''
+    global heading, arrival, fresh, pending
+    if not select.select([fd], [], [], timeout)[0]: return
+    data = os.read(fd, 65536)
+    if not data: raise EOFError()
+    now = arena.monotonic()
+    lines = (pending + data).split("\n")
+    pending = lines.pop()
+    # only the most recent sample matters
+    for line in reversed(lines):
+        words = line.split()
+        try:
+            value = float(words[-1])
+        except (IndexError, ValueError):
+            continue
+        heading, arrival, fresh = value, now, True
+        break
+
+def wait_input(fd, seconds):
+    "Read samples until the given time has passed."
+    end = arena.monotonic() + seconds
+    while True:
+        now = arena.monotonic()
+        if now >= end: return
+        read_input(fd, end - now)
+
+### STIMULUS ###
+
+def draw_pattern():
+    "Draw the bar pattern at rotation 0."
+    global fg_col, bg_col, bar_width, offset
+    for x in range(0, arena.width, bar_width):
+        if x // bar_width % 2 == 0: colour = fg_col
+        else: colour = bg_col
+        arena.fill_columns(x, x+bar_width-1, colour)
+    offset = 0
+
+def rotation(value):
+    "The rotation of the pattern in pixels for a heading in degrees."
+    global gain, transfer
+    if transfer is not None: return transfer(value)
+    return gain * value * arena.width / 360.0
+
+def draw_frame(t, fd):
+    "Rotate the pattern to the most recent heading, and show it."
+    global heading, arrival, fresh, offset, latency_log
+    read_input(fd)
+    target = int(round(rotation(heading))) % arena.width
+    if target != offset:
+        arena.scroll((target - offset) % arena.width)
+        offset = target
+    arena.render()
+    if fresh:
+        latency_log.append((arrival, arena.monotonic(), heading, offset))
+        fresh = False
+
+def follow(source, fps=100, ticks=-1, draw_fn=draw_pattern):
+    '''
+    Run the closed loop: draw the pattern (by calling draw_fn), then rotate it
+    to follow the tracker at the given framerate (for ticks frames, or
+    forever if -1, or until the stream ends).
+    '''
+    global latency_log, log_window, offset, heading, arrival, fresh
+    fd = open_input(source)
+    latency_log = collections.deque(maxlen=log_window)
+    # draw_fn draws the pattern unrotated, and the previous run's samples
+    # must not be shown
+    offset = 0
+    heading, arrival, fresh = 0.0, None, False
+    # the frames are shown when render() returns, so the latency is measured
+    # up to the end of `strip.show()`
+    arena.set_double_buffer(False)
+    try:
+        draw_fn()
+        arena.render()
+        arena.animate(lambda t: draw_frame(t, fd), fps, ticks,
+                      wait=lambda seconds: wait_input(fd, seconds))
+    except EOFError:
+        pass
+    finally:
+        close_input(fd)
+
+### LATENCY ###
+
+def print_latency():
+    "Print a summary of the latency from sample arrival to the panels."
+    global latency_log
+    times = sorted((shown - arrived)*1000
+                   for arrived, shown, value, rot in latency_log)
+    n = len(times)
+    if n == 0: return
+    print "Latency (ms) over %d samples: mean %.3f, median %.3f, " \
+        "95%% %.3f, max %.3f" % (n, sum(times)/n, times[n//2],
+                                 times[min(n-1, int(n*0.95))], times[-1])
+
+def write_log(path):
+    "Write the latency log to a CSV file."
+    global latency_log
+    out = open(path, "w")
+    try:
+        out.write("arrival,shown,latency_ms,heading,offset\n")
+        for arrived, shown, value, rot in latency_log:
+            out.write("%.6f,%.6f,%.3f,%g,%d\n" %
+                      (arrived, shown, (shown-arrived)*1000, value, rot))
+    finally:
+        out.close()
+
+def parse_args():
+    "Parse the commandline arguments (see the usage note above)."
+    global gain
+    args = sys.argv[1:]
+    if not args:
+        print "Usage: ./closed_loop.py <input> [fps] [gain] [mode] [log file]"
+        sys.exit(1)
+    source = args[0]
+    if len(args) > 1: fps = float(args[1])
+    else: fps = 100
+    if len(args) > 2: gain = float(args[2])
+    if len(args) > 3: mode = args[3]
+    else: mode = "PARALLEL"
+    def display():
+        try:
+            follow(source, fps)
+        finally:
+            print_latency()
+            if len(args) > 4: write_log(args[4])
+    arena.run(display, mode)
+
+if __name__ == '__main__':
+    parse_args()
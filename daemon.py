@@ -0,0 +1,322 @@
+#!/usr/bin/python2
+### Control the LEDs in the ZooII Monarch butterfly arena.
+###
+### A long-running process that owns the arena hardware, so that experiment
+### scripts don't have to set it up (and tear it down) for every trial, and
+### the panels keep showing the last frame in between. The framebuffer is
+### shared with the scripts through a memory-mapped file in /dev/shm, and
+### commands are sent over a Unix socket.
+###
+### Usage: './daemon.py [mode] [command ...]'. Without a command, start the
+### daemon in the given mode (default: PARALLEL). Otherwise, send the command
+### (e.g. 'clear blue', 'mode DUPLICATE', 'stats', 'shutdown') to a running
+### daemon and print its reply.
+###
+### Scripts use the daemon by calling `daemon.run()` instead of `arena.run()`.
+### All drawing functions of arena.py and shape.py then write directly into
+### the shared framebuffer, and `arena.render()` passes the panel updates it
+### collects to the daemon (with the panels that show each of them).
+###
+### Licensed under the terms of the GNU GPLv3
+
+import os, sys, mmap, socket, select, signal
+import arena
+
+## The Unix socket for commands, and the shared framebuffer
+global socket_file, shm_file
+socket_file = "/tmp/monarch-arena.sock"
+if os.path.isdir("/dev/shm"): shm_file = "/dev/shm/monarch-arena"
+else: shm_file = "/tmp/monarch-arena.shm"
+
+## The shared file holds the framebuffer, followed by an area for panel
+## updates. Each is large enough for the framebuffer in every mode (128x16
+## pixels of 4 bytes each), the current mode only uses its start.
+global frame_size, shm_size
+frame_size = 128 * 16 * 4
+shm_size = 2 * frame_size
+
+### DAEMON ###
+
+## PROTOCOL
+## Each command is a line of text, and is answered by a line starting with
+## "ok" or "error". The commands are:
+## "info":           reply "ok <mode> <shm file> <framebuffer size>"
+## "render":         show the shared framebuffer (the reply is sent as soon as
+##                   the framebuffer has been copied, so the client can start
+##                   drawing the next frame while this one is sent)
+## "updates <mask> ...": send panel updates to the panels: the data of update
+##                   i (one panel's worth) is at index i of the update area,
+##                   and goes to the pins whose bits are set in its mask
+##                   (replied to as soon as the data has been copied)
+## "clear [colour]": clear the framebuffer and show it
+## "brightness <b>": set the brightness of the LEDs (0-1, see
+##                   `arena.set_brightness()`), and resend every panel
+## "mode <mode>":    change the mode (clearing the framebuffer), reply as
+##                   "info"
+## "stats":          reply "ok <pushed> <skipped> <transfers>" (see
+##                   `arena.render_stats`)
+## "shutdown":       stop the daemon
+
+def info():
+    "The reply to the 'info' command."
+    global shm_file
+    return "ok %s %s %d" % (arena.MODE, shm_file, len(arena.arena))
+
+def handle(line, shared):
+    '''
+    Execute a command (other than 'render') and return the reply. shared is
+    the mapped framebuffer. Raises SystemExit on 'shutdown'.
+    '''
+    words = line.split()
+    if not words: return "error empty command"
+    command, args = words[0], words[1:]
+    if command == "info":
+        return info()
+    elif command == "clear":
+        if args: arena.clear(args[0])
+        else: arena.clear()
+        shared[:len(arena.arena)] = bytes(arena.arena)
+        return "ok"
+    elif command == "brightness":
+        if len(args) != 1: return "error usage: brightness <0-1>"
+        # (gamma correction is applied by the clients as they draw)
+        arena.set_brightness(float(args[0]), arena.gamma)
+        arena.render()
+        return "ok"
+    elif command == "mode":
+        if len(args) != 1: return "error usage: mode <mode>"
+        arena.set_mode(args[0])
+        arena.clear()
+        shared[:len(arena.arena)] = bytes(arena.arena)
+        return info()
+    elif command == "stats":
+        return "ok %(pushed)d %(skipped)d %(transfers)d" % arena.render_stats
+    elif command == "shutdown":
+        raise SystemExit()
+    else:
+        return "error unknown command "+command
+
+def show_updates(updates):
+    "Send the panel updates of an 'updates' command, as (mask, data) pairs."
+    pbytes = arena.pwidth*arena.height*4
+    if arena.MODE == "TEXT":
+        # (TEXT mode has the PARALLEL layout, with one pin per panel)
+        for mask, data in updates:
+            for p in range(arena.npanels):
+                if mask >> p & 1: arena.arena[p*pbytes:(p+1)*pbytes] = data
+        arena.changed_panels = [True] * arena.npanels
+        arena.render()
+        return
+    for mask, data in updates:
+        for i in range(len(arena.pins)):
+            if mask >> i & 1: arena.shown[i] = data
+    arena.render_stats["pushed"] += len(updates)
+    arena.render_stats["transfers"] += len(updates)
+    if arena.output_thread is not None:
+        arena.check_output_thread()
+        arena.output_queue.put((updates, None))
+    else:
+        for mask, data in updates: arena.output(mask, data)
+
+def serve():
+    "Run the daemon until it receives 'shutdown' (or SIGTERM)."
+    global socket_file, shm_file, frame_size, shm_size
+    # make SIGTERM shut down cleanly, like Ctrl-C
+    def terminate(signum, frame): raise SystemExit()
+    signal.signal(signal.SIGTERM, terminate)
+    fd = os.open(shm_file, os.O_RDWR | os.O_CREAT, 0600)
+    try:
+        os.ftruncate(fd, shm_size)
+        shared = mmap.mmap(fd, shm_size)
+    finally:
+        os.close(fd)
+    if os.path.exists(socket_file): os.remove(socket_file)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_file)
+    server.listen(5)
+    # received text of each client that doesn't form a whole line yet
+    clients = {}
+    arena.set_double_buffer(True)
+    arena.clear()
+    try:
+        while True:
+            readable = select.select([server] + clients.keys(), [], [])[0]
+            for s in readable:
+                if s is server:
+                    client = server.accept()[0]
+                    clients[client] = ""
+                    continue
+                data = s.recv(4096)
+                if not data:
+                    del clients[s]
+                    s.close()
+                    continue
+                lines = (clients[s] + data).split("\n")
+                clients[s] = lines.pop()
+                for line in lines:
+                    words = line.split()
+                    if words and words[0] == "updates":
+                        pbytes = arena.pwidth*arena.height*4
+                        updates = []
+                        for i, mask in enumerate(words[1:]):
+                            start = frame_size + i*pbytes
+                            updates.append((int(mask), bytearray(
+                                shared[start:start+pbytes])))
+                        s.sendall("ok\n")
+                        show_updates(updates)
+                        continue
+                    if line.strip() == "render":
+                        arena.arena[:] = shared[:len(arena.arena)]
+                        # only the panels whose content differs from what
+                        # they show are sent
+                        arena.changed_panels = [True] * arena.npanels
+                        # the client may draw the next frame in the meantime
+                        s.sendall("ok\n")
+                        arena.render()
+                        continue
+                    try:
+                        reply = handle(line, shared)
+                    except SystemExit:
+                        s.sendall("ok\n")
+                        return
+                    except Exception as e:
+                        reply = "error "+str(e)
+                    s.sendall(reply+"\n")
+    finally:
+        for s in clients: s.close()
+        server.close()
+        shared.close()
+        os.remove(socket_file)
+        os.remove(shm_file)
+
+### CLIENT ###
+
+## The connection to the daemon, the mapped framebuffer, the mapped update
+## area, and the brightness last passed to the daemon (None if unknown)
+global connection, replies, shared, update_area, sent_brightness
+connection, replies, shared, update_area = None, None, None, None
+sent_brightness = None
+
+def command(line):
+    "Send a command to the daemon and return its reply (without 'ok')."
+    global connection, replies
+    connection.sendall(line+"\n")
+    reply = replies.readline().strip()
+    if reply == "ok": return ""
+    elif reply.startswith("ok "): return reply[3:]
+    elif reply.startswith("error"):
+        raise Exception("Daemon: "+reply[6:])
+    else: raise Exception("Lost the connection to the daemon.")
+
+def send_updates(updates, raw=False):
+    '''
+    Pass panel updates to the daemon (this is `arena.sink`): their data is
+    written to the update area, as many as fit at a time, and their masks are
+    sent with an 'updates' command. This works for the updates collected by
+    `arena.render()` and for raw ones (e.g. from a cache file) alike. If
+    `arena.set_brightness()` was called, the daemon is told first.
+    '''
+    global update_area, frame_size, sent_brightness
+    if not updates: return
+    if arena.brightness != sent_brightness:
+        command("brightness %r" % arena.brightness)
+        sent_brightness = arena.brightness
+    pbytes = arena.pwidth*arena.height*4
+    per_command = frame_size // pbytes
+    for start in range(0, len(updates), per_command):
+        chunk = updates[start:start+per_command]
+        for i, (mask, data) in enumerate(chunk):
+            update_area[i*pbytes:(i+1)*pbytes] = bytes(data)
+        # (the daemon replies once it has copied the data)
+        command("updates "+" ".join(str(mask) for mask, data in chunk))
+
+def attach(mode, path, size):
+    "Set up arena.py to draw into the daemon's framebuffer."
+    global shared, update_area, frame_size, sent_brightness
+    if shared is not None:
+        arena.arena = None # (set_mode() makes a new buffer)
+        shared.close()
+        update_area.close()
+    # TEXT mode has the same dimensions as PARALLEL, and this process doesn't
+    # print anything itself
+    if mode == "TEXT": arena.set_mode("PARALLEL")
+    else: arena.set_mode(mode)
+    f = open(path, "r+b")
+    try:
+        shared = mmap.mmap(f.fileno(), int(size))
+        update_area = mmap.mmap(f.fileno(), frame_size, offset=frame_size)
+    finally:
+        f.close()
+    if len(shared) != len(arena.arena):
+        raise Exception("The daemon's framebuffer doesn't match mode "+mode)
+    shared[:] = bytes(arena.arena)
+    arena.arena = shared
+    # instead of sending the panel updates to the device, pass them to the
+    # daemon (the panels each goes to are part of the update, so panel
+    # selection in DUPLICATE mode works as with local output)
+    arena.sink = send_updates
+    sent_brightness = None
+
+def connect(path=None):
+    '''
+    Connect to the daemon. From then on, arena.py draws into the daemon's
+    framebuffer, and `arena.render()` shows it.
+    '''
+    global connection, replies, socket_file
+    if path is None: path = socket_file
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.connect(path)
+    replies = connection.makefile("r")
+    attach(*command("info").split())
+
+def set_mode(mode):
+    "Change the daemon's mode (use this instead of `arena.set_mode()`)."
+    attach(*command("mode "+mode).split())
+
+def disconnect():
+    "Close the connection to the daemon, and draw into a local buffer again."
+    global connection, replies, shared, update_area
+    arena.sink = None
+    arena.arena = bytearray(arena.arena[:])
+    if shared is not None:
+        shared.close()
+        update_area.close()
+    if connection is not None:
+        replies.close()
+        connection.close()
+    connection, replies, shared, update_area = None, None, None, None
+
+def run(display_fn, mode=None):
+    '''
+    Like `arena.run()`, but draw through the daemon: the hardware stays set up
+    and keeps showing the last frame when display_fn returns.
+    '''
+    try:
+        connect()
+        if mode is not None and mode != arena.MODE: set_mode(mode)
+        display_fn()
+    except KeyboardInterrupt:
+        print "Terminating."
+    except Exception as e:
+        print "Error:", e
+    finally:
+        arena.print_frame_stats()
+        disconnect()
+
+def parse_args():
+    "Start the daemon, or send it a command (see the usage note above)."
+    args = sys.argv[1:]
+    mode = "PARALLEL"
+    if args and args[0] in ("TEXT", "SERIAL", "PARALLEL", "DUPLICATE"):
+        mode = args.pop(0)
+    if args:
+        channel = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        channel.connect(socket_file)
+        channel.sendall(" ".join(args)+"\n")
+        print channel.makefile("r").readline().strip()
+        channel.close()
+    else:
+        arena.run(serve, mode)
+
+if __name__ == '__main__':
+    parse_args()
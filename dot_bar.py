@@ -5,14 +5,16 @@
 ### University of Wuerzburg, Center for Computational and Theoretical Biology
 ### Licensed under the terms of the GNU GPLv3
 
-### Usage: './dot_bar.py <dot_mode> <bar_mode> <display_mode> <fps>', where
+### Usage: './dot_bar.py <dot_mode> <bar_mode> <display_mode> <fps> <cache>',
+### where
 ### <dot_mode> and <bar_mode> are 0 (not shown), 1 (stationary), or 2 (moving)
 ### <display_mode> is TEXT or PARALLEL
 ### <fps> is the delay in sec^-1 between screen updates
+### <cache> if this is "cache" or "true", replay the animation from a cache file
 
 
-import arena, shape
-import sys, time
+import arena, framecache
+import sys
 
 ### SETTINGS ###
 
@@ -42,33 +44,54 @@ else:
 # Animation speed in frames per second
 global fps
 fps = 21
+
+# Record the animation once and replay it from a cache file, rather than
+# drawing each frame live (see framecache.py)
+global cache
+cache = False
     
 
 ### FUNCTIONS ###
 
-def draw_bar(t, x0_bar=arena.width/2):
-    "Draw the bar at timestep t."
-    global bar_mode, bg_col, bar_col
+def draw_bar(t, x0_bar=None):
+    "Move the bar to its position at timestep t (x0_bar default: the middle)."
+    global bar_mode, bar_col
+    if x0_bar is None: x0_bar = arena.width/2
     if bar_mode == 0: return
-    elif bar_mode == 1:
-        shape.plot(shape.line(x0_bar, 0, x0_bar, arena.height), bar_col)
-    elif bar_mode == 2:
-        shape.plot(shape.line(x0_bar+t-1, 0, x0_bar+t-1, arena.height), bg_col)
-        shape.plot(shape.line(x0_bar+t, 0, x0_bar+t, arena.height), bar_col)
+    elif bar_mode == 1: x = x0_bar
+    elif bar_mode == 2: x = x0_bar+t
     else:
         raise Exception("Invalid bar mode: "+str(bar_mode))
+    arena.set_sprite("bar", [(y, 0, 0) for y in range(arena.height)],
+                     bar_col, x=x)
 
 def draw_dot(t, x0_dot=0, y_dot=6):
-    "Draw the dot at timestep t."
-    global dot_mode, bg_col, dot_col
+    "Move the dot to its position at timestep t."
+    global dot_mode, dot_col
     if dot_mode == 0: return
-    elif dot_mode == 1:
-        arena.set_pixel(x0_dot, y_dot, dot_col)
-    elif dot_mode == 2:
-        arena.set_pixel(x0_dot-t+1, y_dot, bg_col)
-        arena.set_pixel(x0_dot-t, y_dot, dot_col)
+    elif dot_mode == 1: x = x0_dot
+    elif dot_mode == 2: x = x0_dot-t
     else:
         raise Exception("Invalid dot mode: "+str(dot_mode))
+    arena.set_sprite("dot", [(0, 0, 0)], dot_col, x=x, y=y_dot)
+
+def draw_frame(t):
+    "Draw frame t of the animation (repeats after `arena.width` frames)."
+    global bg_col
+    if t == 0 or arena.background is None:
+        # the bar and dot are sprites on a plain background (the dot on top)
+        arena.clear_layers()
+        arena.set_background(lambda: arena.clear(bg_col, show=False))
+    draw_bar(t+1)
+    draw_dot(t+1)
+
+def frames():
+    "Yield the frames of the animation, forever (see `arena.play()`)."
+    t = 0
+    while True:
+        draw_frame(t)
+        yield
+        t = t + 1
 
 def animate(ticks=-1):
     '''
@@ -77,15 +100,14 @@ def animate(ticks=-1):
     ticks: number of ticks to run the animation for (-1 -> forever)
     fps: framerate in ticks per second (default: 21fps = 60deg/s)
     '''
-    global bg_col, fps
-    arena.clear(bg_col, show=False)
-    i = 0
-    while i != ticks:
-        i = i + 1 # infinity loop if ticks = -1
-        draw_bar(i)
-        draw_dot(i)
-        arena.render()
-        time.sleep(1.0/fps)   
+    global bg_col, bar_col, dot_col, dot_mode, bar_mode, fps, cache
+    if cache:
+        params = {"dot_mode":dot_mode, "bar_mode":bar_mode, "bg_col":bg_col,
+                  "bar_col":bar_col, "dot_col":dot_col}
+        path = framecache.cached("dot_bar", params, draw_frame, arena.width)
+        framecache.play(path, fps, ticks)
+        return
+    arena.play(frames(), fps, ticks)
 
 def parse_args():
     '''
@@ -94,9 +116,10 @@ def parse_args():
     2nd param: bar_mode
     3rd param: display_mode
     4th param: fps
+    5th param: cache
     '''
-    global dot_mode, bar_mode, display_mode, bg_col, bar_col, fps
-    if len(sys.argv) == 2 or len(sys.argv) > 5:
+    global dot_mode, bar_mode, display_mode, bg_col, bar_col, fps, cache
+    if len(sys.argv) == 2 or len(sys.argv) > 6:
         raise Exception("Bad number of args. See the source for details.")
     if len(sys.argv) >= 3:
         dot_mode = int(sys.argv[1])
@@ -107,8 +130,11 @@ def parse_args():
             bg_col, bar_col = "black", "blue"
         else:
             bg_col, bar_col = "blue", "black"
-    if len(sys.argv) == 5:
+    if len(sys.argv) >= 5:
         fps = int(sys.argv[4])
+    if len(sys.argv) == 6:
+        if sys.argv[5] in ("cache", "True", "true", "TRUE"):
+            cache = True
     
         
 if __name__ == '__main__':
@@ -1,23 +1,51 @@
 #!/usr/bin/python
 # A mockup of the dotstar library to allow arena.py to run while not
 # on the production system...
+# It can simulate how long the transfers would take on the real hardware,
+# and record each transfer, so that the library's performance can be measured
+# on a development machine.
 # Daniel Vedder
 
+import time
+import RPi.GPIO as GPIO
+
 class Adafruit_DotStar():
 
+    # If simulate is true, show() takes as long as the transfer would take
+    simulate = False
+
+    # If record is true, each call to show() is appended to log as a tuple
+    # (start time, pins set to HIGH, number of bytes, transfer time)
+    record = False
+    log = []
+
     def __init__(self, length, hertz):
-        pass
+        self.length = length
+        self.hertz = hertz
 
     def begin(self):
         pass
 
+    def numPixels(self):
+        return self.length
+
     def setPixelColor(self, i, colour):
         pass
+
+    def transfer_time(self, nbytes):
+        "The seconds needed to send nbytes of pixel data over SPI."
+        # a 4 byte start frame, the data, and an end frame of at least
+        # one bit per two LEDs
+        return (4 + nbytes + (self.length+15)//16) * 8.0 / self.hertz
     
-    def show(self):
-        pass
+    def show(self, buf=None):
+        if buf is None: nbytes = self.length * 4
+        else: nbytes = len(buf)
+        duration = self.transfer_time(nbytes)
+        if self.record:
+            self.log.append((time.time(), GPIO.high_pins(), nbytes, duration))
+        if self.simulate: time.sleep(duration)
 
     class Color():
         def __init__(self, r, g, b):
             pass
-
@@ -0,0 +1,365 @@
+#!/usr/bin/python2
+### Control the LEDs in the ZooII Monarch butterfly arena.
+###
+### This is a library module that is meant to be imported by experiment scripts.
+### It records periodic animations as raw strip data in a cache file, which can
+### then be replayed without any drawing work in Python. This allows much
+### higher and more stable frame rates than drawing each frame live.
+###
+### Usage: './framecache.py check [workers]' records some of the scripts'
+### animations in a pool of processes (default: 2) and in one, and exits with
+### an error unless the cache files are identical.
+###
+### Licensed under the terms of the GNU GPLv3
+
+import os, sys, time, mmap, struct, inspect, hashlib, filecmp, multiprocessing
+import arena, shape
+
+## Cache files are stored here, named after the animation and a hash of its
+## parameters (so repeated trials with the same settings reuse the file)
+global cache_dir
+cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache")
+
+## FILE FORMAT
+## header: magic, version, mode, number of frames, bytes per update,
+##         offset of the frame index
+## frames: number of updates (H), then for each update its pin mask (B) and
+##         the raw strip data
+## index:  the file offset of each frame (Q)
+global magic, version, header_fmt
+magic = "MACF"
+version = 1
+header_fmt = "<4sB12sIIQ"
+
+## The cache file name also depends on the source code that draws the
+## frames (arena.py, shape.py, and the animation's module), so that editing
+## it doesn't replay stale frames. Increase `key_version` when the frames
+## would change in some other way.
+global key_version, source_digests
+key_version = 1
+source_digests = {}
+
+def source_digest(module):
+    "Get a hash of the source file of a module (cached until it changes)."
+    global source_digests
+    path = inspect.getsourcefile(module) or inspect.getfile(module)
+    mtime = os.path.getmtime(path)
+    if source_digests.get(path, (None,))[0] != mtime:
+        f = open(path, "rb")
+        try:
+            source_digests[path] = (mtime, hashlib.sha1(f.read()).hexdigest())
+        finally:
+            f.close()
+    return source_digests[path][1]
+
+def cache_path(name, params, module=None):
+    '''
+    Get the cache file name for an animation with the given parameters, drawn
+    by the code in module (in addition to arena.py and shape.py).
+    '''
+    global key_version
+    modules = [arena, shape]
+    if module is not None: modules.append(module)
+    # (the gamma correction changes the values of (r, g, b) colours)
+    key = repr((name, sorted(params.items()), arena.MODE,
+                sorted(arena.colours.items()), arena.gamma, version,
+                key_version, [source_digest(m) for m in modules]))
+    digest = hashlib.sha1(key).hexdigest()[:12]
+    return os.path.join(cache_dir, name+"-"+digest+".frames")
+
+def record_frames(frame_fn, start, end, overlap=0):
+    '''
+    Render frames start to end-1 of an animation offscreen, and yield each
+    frame's updates encoded as in a cache file. The first frame drawn updates
+    every panel. If overlap is given, that many frames before start are drawn
+    first (but not yielded).
+    '''
+    if arena.MODE == "TEXT":
+        raise Exception("Cannot record animations in TEXT mode.")
+    frame = []
+    def record(updates, raw=False): frame.extend(updates)
+    # The first frame must update every panel, so that playback does not
+    # depend on what the arena happened to show before
+    arena.shown = [None] * len(arena.pins)
+    arena.changed_panels = [True] * arena.npanels
+    # (e.g. daemon.py's sink, which must be restored afterwards)
+    previous = arena.sink
+    arena.sink = record
+    try:
+        for t in range(max(0, start-overlap), end):
+            del frame[:]
+            frame_fn(t)
+            arena.render()
+            if t < start: continue
+            yield struct.pack("<H", len(frame)) + \
+                "".join(struct.pack("<B", mask) + bytes(data)
+                        for mask, data in frame)
+    finally:
+        arena.sink = previous
+        # we don't know what the panels show now
+        arena.shown = [None] * len(arena.pins)
+
+def write_cache(path, frames):
+    "Write a cache file from the encoded frames of an animation (any iterable)."
+    pbytes = arena.pwidth*arena.height*4
+    index = []
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    cache = open(path+".tmp", "wb")
+    cache.write(struct.pack(header_fmt, magic, version, arena.MODE,
+                            0, pbytes, 0))
+    for frame in frames:
+        index.append(cache.tell())
+        cache.write(frame)
+    index_offset = cache.tell()
+    cache.write(struct.pack("<"+str(len(index))+"Q", *index))
+    cache.seek(0)
+    cache.write(struct.pack(header_fmt, magic, version, arena.MODE,
+                            len(index), pbytes, index_offset))
+    cache.close()
+    os.rename(path+".tmp", path)
+
+def compile_animation(frame_fn, nframes, path):
+    '''
+    Render an animation offscreen and store it in a cache file.
+    frame_fn: A function that draws frame t when called as `frame_fn(t)`.
+              It may call `arena.render()` itself (e.g. to toggle panels in
+              between), otherwise the frame is rendered afterwards.
+    nframes: The number of frames to record (one period of the animation)
+    path: The file to write to
+    '''
+    write_cache(path, record_frames(frame_fn, 0, nframes))
+
+## PARALLEL COMPILATION
+## Animations can be recorded by a pool of processes. Several animations
+## (e.g. the trials of a session) are independent, so each is recorded whole
+## by one process. Only long animations are also split into ranges of at
+## least `min_range` frames. A process can't take over the arena state (the
+## layers, and what each pin shows) from the one recording the previous
+## range, so it draws `overlap` frames before its range to rebuild it. The
+## cache file is then identical to one recorded in order, provided that every
+## pin is updated at least once during the overlap, and that frame t doesn't
+## depend on frames drawn before that (as in all animations of the scripts).
+global min_range
+min_range = 256
+
+## The frames recorded by each worker process in the last call to
+## `compile_parallel()`, and the seconds it needed (process id -> [frames,
+## seconds])
+global worker_stats
+worker_stats = {}
+
+def compile_range(job):
+    "Record a range of frames in a worker process (see `compile_batch()`)."
+    setup, args, mode, start, end, overlap = job
+    begin = time.time()
+    # the output thread of the parent process doesn't exist in this one
+    arena.output_thread, arena.output_queue = None, None
+    # start from a cleared arena without layers, like a new process
+    arena.set_mode(mode)
+    frames = list(record_frames(setup(*args), start, end, overlap))
+    return start, frames, os.getpid(), time.time() - begin
+
+def split_ranges(nframes, workers):
+    "Split an animation into the (start, end) ranges of frames to record."
+    global min_range
+    # several ranges per worker, so that they finish at about the same time
+    size = max(min_range, -(-nframes // (workers*4)))
+    return [(start, min(nframes, start+size))
+            for start in range(0, nframes, size)]
+
+def compile_batch(animations, workers=None, overlap=1, verify=False):
+    '''
+    Render several animations offscreen in one pool of processes, and store
+    each in its cache file (identical to the one `compile_animation()` would
+    write). Returns the worker statistics of each animation (see
+    `worker_stats`).
+    animations: A list of (setup, args, nframes, path) tuples. `setup(*args)`
+                returns the animation's frame function. setup must be a
+                module-level function, so that it can be passed to other
+                processes.
+    workers: The number of processes (default: one per CPU core)
+    overlap: The number of frames drawn before each range (see above)
+    verify: Also record each animation in order, and raise an exception if
+            the files differ
+    '''
+    if arena.MODE == "TEXT":
+        raise Exception("Cannot record animations in TEXT mode.")
+    if workers is None: workers = multiprocessing.cpu_count()
+    mode = arena.MODE
+    jobs, counts = [], []
+    for setup, args, nframes, path in animations:
+        ranges = split_ranges(nframes, workers)
+        # a whole animation doesn't need to catch up with anything
+        if len(ranges) == 1: jobs.append((setup, args, mode, 0, nframes, 0))
+        else: jobs.extend((setup, args, mode, start, end, overlap)
+                          for start, end in ranges)
+        counts.append(len(ranges))
+    arena.wait() # (the output thread can't be copied into the workers)
+    stats = []
+    def frames(results, count, animation_stats):
+        # the ranges arrive in order, and are written as they arrive
+        for i in range(count):
+            start, recorded, pid, seconds = next(results)
+            worker = animation_stats.setdefault(pid, [0, 0.0])
+            worker[0] += len(recorded)
+            worker[1] += seconds
+            for frame in recorded: yield frame
+    pool = multiprocessing.Pool(min(workers, len(jobs)))
+    try:
+        results = pool.imap(compile_range, jobs)
+        for (setup, args, nframes, path), count in zip(animations, counts):
+            stats.append({})
+            write_cache(path, frames(results, count, stats[-1]))
+    finally:
+        pool.close()
+        pool.join()
+    if verify:
+        for setup, args, nframes, path in animations:
+            # each animation starts from a cleared arena, as in the workers
+            arena.set_mode(mode)
+            compile_animation(setup(*args), nframes, path+".serial")
+            try:
+                if not filecmp.cmp(path, path+".serial", shallow=False):
+                    raise Exception(path+" differs from the frames recorded "
+                                    "in order.")
+            finally:
+                os.remove(path+".serial")
+    return stats
+
+def compile_parallel(setup, args, nframes, path, workers=None, overlap=1,
+                     verify=False):
+    '''
+    Render an animation offscreen in a pool of processes, and store it in a
+    cache file (see `compile_batch()`). Animations shorter than `min_range`
+    frames are recorded by a single process.
+    '''
+    global worker_stats
+    worker_stats = compile_batch([(setup, args, nframes, path)], workers,
+                                 overlap, verify)[0]
+
+def print_worker_stats():
+    "Print the framerate of each worker of the last `compile_parallel()`."
+    global worker_stats
+    for pid in sorted(worker_stats):
+        frames, seconds = worker_stats[pid]
+        print "Worker %d: %d frames in %.3f s (%.1f fps)" % \
+            (pid, frames, seconds, frames / max(seconds, 1e-9))
+
+def load(path):
+    '''
+    Memory-map a cache file. Returns the mapped file, the size of an update,
+    and a list with the updates of each frame as (pin mask, data offset) pairs.
+    '''
+    cache = open(path, "rb")
+    frames = mmap.mmap(cache.fileno(), 0, access=mmap.ACCESS_READ)
+    cache.close()
+    head, vers, mode, nframes, pbytes, index_offset = \
+        struct.unpack_from(header_fmt, frames)
+    if head != magic or vers != version:
+        raise Exception(path+" is not a valid cache file.")
+    if mode.rstrip("\0") != arena.MODE:
+        raise Exception(path+" was recorded in "+mode.rstrip("\0")+" mode.")
+    index = struct.unpack_from("<"+str(nframes)+"Q", frames, index_offset)
+    updates = []
+    for offset in index:
+        n = struct.unpack_from("<H", frames, offset)[0]
+        offset = offset + 2
+        frame = []
+        for u in range(n):
+            frame.append((ord(frames[offset]), offset+1))
+            offset = offset + 1 + pbytes
+        updates.append(frame)
+    return frames, pbytes, updates
+
+def replay(frames, pbytes, updates):
+    '''
+    Yield the updates of each frame of a loaded cache file (see `load()`),
+    looping over its frames forever (see `arena.play()`).
+    '''
+    while True:
+        for frame in updates:
+            yield [(mask, frames[offset:offset+pbytes])
+                   for mask, offset in frame]
+
+def play(path, fps, ticks=-1):
+    '''
+    Replay a cache file at the given framerate, looping over its frames.
+    ticks: number of frames to show (-1 -> forever)
+    '''
+    frames, pbytes, updates = load(path)
+    try:
+        arena.play(replay(frames, pbytes, updates), fps, ticks)
+    finally:
+        frames.close()
+        arena.shown = [None] * len(arena.pins)
+
+def cached(name, params, frame_fn, nframes):
+    '''
+    Get the cache file for an animation, compiling it first if necessary.
+    name, params: The animation's name and a dict of all settings that
+                  influence its appearance (these identify the cache file,
+                  together with the source of frame_fn's module)
+    '''
+    path = cache_path(name, params, inspect.getmodule(frame_fn))
+    if not os.path.exists(path):
+        compile_animation(frame_fn, nframes, path)
+    return path
+
+## CHECKING
+
+def check_parallel(workers=2):
+    '''
+    Record animations of the scripts with `compile_batch()` and in order, and
+    raise an exception unless the cache files are identical. In each mode,
+    one animation is long enough to be split into several ranges.
+    '''
+    import tempfile, shutil, protocol
+    global min_range
+    long_run = 3*min_range
+    trials = {"PARALLEL": [({"stimulus": "dot_bar"}, 128),
+                           ({"stimulus": "landscape"}, 128),
+                           ({"stimulus": "dot_bar", "bar_mode": 2,
+                             "direction": -1}, long_run)],
+              "DUPLICATE": [({"stimulus": "optic_flow"}, 8),
+                            ({"stimulus": "optic_flow", "fast": True,
+                              "direction": "ROTATE_LEFT"}, long_run)]}
+    if len(split_ranges(long_run, workers)) < 2:
+        raise Exception("%d frames are not split between %d workers." %
+                        (long_run, workers))
+    tmp = tempfile.mkdtemp()
+    try:
+        for mode in sorted(trials):
+            arena.set_mode(mode)
+            animations = [(protocol.trial_frame_fn, (trial,), nframes,
+                           os.path.join(tmp, "%s-%d.frames" % (mode, i)))
+                          for i, (trial, nframes) in enumerate(trials[mode])]
+            compile_batch(animations, workers)
+            for setup, args, nframes, path in animations:
+                # each animation starts from a cleared arena, as in the pool
+                arena.set_mode(mode)
+                compile_animation(setup(*args), nframes, path+".serial")
+                if not filecmp.cmp(path, path+".serial", shallow=False):
+                    raise Exception("%s (%d frames, %s mode) differs from "
+                                    "the frames recorded in order." %
+                                    (args[0]["stimulus"], nframes, mode))
+    finally:
+        shutil.rmtree(tmp)
+
+def parse_args():
+    "Check parallel recording (see the usage note above)."
+    args = sys.argv[1:]
+    if not args or args[0] != "check" or len(args) > 2:
+        print "Usage: ./framecache.py check [workers]"
+        sys.exit(1)
+    if len(args) == 2: workers = int(args[1])
+    else: workers = 2
+    try:
+        check_parallel(workers)
+    except Exception as e:
+        print "Error:", e
+        sys.exit(1)
+    print "The frames recorded by %d workers match." % workers
+
+if __name__ == '__main__':
+    parse_args()
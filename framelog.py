@@ -0,0 +1,83 @@
+#!/usr/bin/python2
+### Control the LEDs in the ZooII Monarch butterfly arena.
+###
+### Read the frame logs written by `arena.set_frame_log()`, which record when
+### each update reached the panels, e.g. to align the frames with a video of
+### the butterfly's behaviour.
+###
+### Usage: './framelog.py <log file> [csv file]' converts a log to CSV
+### (printed if no CSV file is given).
+###
+### Licensed under the terms of the GNU GPLv3
+
+import sys, struct
+import arena
+
+## The fields of each record (see `arena.set_frame_log()`)
+global fields
+fields = ("time", "frame", "render", "digest", "lateness", "mask")
+
+def read_header(data, path):
+    "Check the header of a log file, and return the size of its header."
+    header = struct.Struct("<4sBH")
+    if len(data) < header.size:
+        raise Exception(path+" is not a frame log.")
+    magic, version, size = header.unpack_from(data)
+    if magic != arena.log_magic or version != arena.log_version or \
+       size != arena.log_record.size:
+        raise Exception(path+" is not a frame log (of this version).")
+    return header.size
+
+def read_log(path):
+    "Read a log file, returning its records as tuples (see `fields`)."
+    f = open(path, "rb")
+    try:
+        data = f.read()
+    finally:
+        f.close()
+    offset = read_header(data, path)
+    size = arena.log_record.size
+    # (a log that is still being written may end with a partial record)
+    end = offset + (len(data) - offset) // size * size
+    return [arena.log_record.unpack_from(data, i)
+            for i in range(offset, end, size)]
+
+def write_csv(path, out=None):
+    "Convert a log file to CSV, written to the file out (default: stdout)."
+    if out is None: stream = sys.stdout
+    else: stream = open(out, "w")
+    try:
+        stream.write("time,frame,render,digest,lateness_ms,mask\n")
+        for time, frame, render, digest, lateness, mask in read_log(path):
+            stream.write("%.6f,%d,%d,%08x,%.3f,0x%02x\n" %
+                         (time, frame, render, digest, lateness*1000, mask))
+    finally:
+        if out is not None: stream.close()
+
+def to_numpy(path):
+    '''
+    Read a log file into a NumPy record array (with the fields in `fields`).
+    Requires NumPy.
+    '''
+    try:
+        import numpy
+    except ImportError:
+        raise Exception("Reading frame logs into arrays requires NumPy.")
+    f = open(path, "rb")
+    try:
+        data = f.read()
+    finally:
+        f.close()
+    offset = read_header(data, path)
+    dtype = numpy.dtype({"names": list(fields),
+                         "formats": ["<f8", "<i4", "<u4", "<u4", "<f4", "u1"],
+                         "offsets": [0, 8, 12, 16, 20, 24],
+                         "itemsize": arena.log_record.size})
+    count = (len(data) - offset) // dtype.itemsize
+    return numpy.frombuffer(data, dtype, count, offset).view(numpy.recarray)
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3):
+        print "Usage: ./framelog.py <log file> [csv file]"
+        sys.exit(1)
+    write_csv(*sys.argv[1:])
@@ -22,7 +22,8 @@ def draw_house():
     shape.plot(shape.line(0,15,127,15), colour="green") #grass
     arena.render()
 
-arena.run(draw_house, "PARALLEL")
+if __name__ == '__main__':
+    arena.run(draw_house, "PARALLEL")
 
 # To run this, execute './house.py' in a shell. Note: the drawn image
 # is not deleted in this script. To clear the arena screen again, call
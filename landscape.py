@@ -5,45 +5,73 @@
 ### University of Wuerzburg, Center for Computational and Theoretical Biology
 ### Licensed under the terms of the GNU GPLv3
 
-import arena, shape
-import time
+import arena, shape, framecache
 
 def draw_panorama(col="magenta"):
     "Draw a panorama of two triangular hills"
     arena.clear("blue", show=False)
-    panorama = shape.line(0,15,127,15) + \
-               shape.triangle(0, 14, 10, 8, 20, 14) + \
-               shape.triangle(64, 14, 69, 5, 74, 14)
-    shape.plot(panorama, colour=col)
+    panorama = shape.line(0,15,127,15, spans=True) + \
+               shape.triangle(0, 14, 10, 8, 20, 14, spans=True) + \
+               shape.triangle(64, 14, 69, 5, 74, 14, spans=True)
+    shape.plot_spans(panorama, colour=col)
 
-def draw_movable_elements(t, x0_pixel=0, x0_strip=arena.width/2, px_foreground=True):
+def draw_movable_elements(t, x0_pixel=0, x0_strip=None, px_foreground=True):
     '''
-    Draw a green pixel and black vertical strip at timestep t.
-    The pixel moves clockwise, the strip ACW around the arena.
+    Move a green pixel and black vertical strip to their positions at
+    timestep t. The pixel moves clockwise, the strip ACW around the arena.
+    (Both are sprites on top of the panorama, see `init_layers()`.)
 
-    x0_pixel, x0_strip: Initial x-coordinates of the elements
+    x0_pixel, x0_strip: Initial x-coordinates of the elements (the strip
+                        starts in the middle by default)
     px_foreground: Should the pixel be in the fore- or background?
     '''
-    if not px_foreground:
-        arena.set_pixel(x0_pixel+t, 6, "green")
-    shape.plot(shape.line(x0_strip-t, 3, x0_strip-t, 9), "black")
-    if px_foreground:
-        arena.set_pixel(x0_pixel+t, 6, "green")
+    if x0_strip is None: x0_strip = arena.width/2
+    if px_foreground: order = ["strip", "pixel"]
+    else: order = ["pixel", "strip"]
+    if arena.sprites.keys() != order:
+        # (re)create the sprites so that they are stacked in the right order
+        for name in order:
+            if name in arena.sprites: arena.remove_sprite(name)
+        for name in order:
+            if name == "pixel":
+                arena.set_sprite("pixel", [(0, 0, 0)], "green")
+            else:
+                arena.set_sprite("strip", shape.vline(0, 0, 6, spans=True),
+                                 "black")
+    arena.set_sprite("pixel", x=x0_pixel+t, y=6)
+    arena.set_sprite("strip", x=x0_strip-t, y=3)
 
-def animate(ticks=-1, fps=21):
+def init_layers():
+    "Use the panorama as the arena background, and remove all sprites."
+    arena.clear_layers()
+    arena.set_background(draw_panorama)
+
+def draw_frame(t):
+    "Draw frame t of the animation (repeats after `arena.width` frames)."
+    if t == 0 or arena.background is None: init_layers()
+    draw_movable_elements(t+1, px_foreground=True)
+
+def frames():
+    "Yield the frames of the animation, forever (see `arena.play()`)."
+    t = 0
+    while True:
+        draw_frame(t)
+        yield
+        t = t + 1
+
+def animate(ticks=-1, fps=21, cache=False):
     '''
     Animate the elements at the given framerate for a set time
     
     ticks: number of ticks to run the animation for (-1 -> forever)
     fps: framerate in ticks per second (default: 21fps = 60deg/s)
+    cache: replay the animation from a cache file (see framecache.py)
     '''
-    i = 0
-    while i != ticks:
-        i = i + 1 # infinity loop if ticks = -1
-        draw_panorama()
-        draw_movable_elements(i, px_foreground=True)
-        arena.render()
-        time.sleep(1.0/fps)   
+    if cache:
+        path = framecache.cached("landscape", {}, draw_frame, arena.width)
+        framecache.play(path, fps, ticks)
+        return
+    arena.play(frames(), fps, ticks)
         
 if __name__ == '__main__':
     arena.run(animate, "PARALLEL")
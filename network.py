@@ -0,0 +1,420 @@
+#!/usr/bin/python2
+### Control the LEDs in the ZooII Monarch butterfly arena.
+###
+### Drive several arenas from one controller over the network. Each arena's
+### Pi runs a frame server ('./network.py [mode] [port]'), and the controller
+### runs an ordinary animation script that calls `network.run()` instead of
+### `arena.run()`: everything it draws is then streamed to the connected
+### arenas by `arena.render()`, as full frames or as updates of the panels
+### that changed.
+###
+### To try it on one machine, start a few servers on different ports (their
+### output goes to the mock hardware, or to the screen in TEXT mode) and
+### connect to each of them on localhost.
+###
+### Licensed under the terms of the GNU GPLv3
+
+import sys, struct, socket, select, collections
+import arena
+
+global default_port
+default_port = 7421
+
+### PROTOCOL ###
+
+## Every message starts with a header of the message type, a sequence number,
+## a timestamp (the sender's monotonic clock, in seconds) and the length of
+## the payload that follows, all in network byte order. The server answers
+## every message with an ACK that echoes its sequence number and timestamp,
+## once the message has been handled (i.e. the frame has been handed to the
+## panels), so the controller can measure the latency of each arena.
+## Message types and their payloads:
+## MODE:    the name of the mode (the server clears the arena)
+## FRAME:   a byte with the panel mask (in DUPLICATE mode, the panels that
+##          show it) and the whole framebuffer
+## UPDATES: any number of panel updates, each a byte with the mask of the
+##          panels it goes to and the strip data of one panel (as passed to
+##          `arena.output()`)
+## PING:    nothing (just measures the latency)
+## ACK:     nothing
+## BRIGHTNESS: the brightness of the LEDs as text (0-1, see
+##          `arena.set_brightness()`), the server resends every panel
+global MODE_MSG, FRAME, UPDATES, PING, ACK, BRIGHTNESS, header, header_size
+MODE_MSG, FRAME, UPDATES, PING, ACK, BRIGHTNESS = range(1, 7)
+header = struct.Struct("!BHdI")
+header_size = header.size
+
+def message(kind, seq, timestamp, payload=""):
+    "Encode a message."
+    global header
+    return header.pack(kind, seq & 0xFFFF, timestamp, len(payload)) + payload
+
+def split_messages(data):
+    '''
+    Split received data into complete messages. Returns a list of
+    (type, seq, timestamp, payload) tuples and the incomplete rest.
+    '''
+    global header, header_size
+    messages, start = [], 0
+    while len(data) - start >= header_size:
+        kind, seq, timestamp, length = header.unpack_from(data, start)
+        end = start + header_size + length
+        if end > len(data): break
+        messages.append((kind, seq, timestamp, data[start+header_size:end]))
+        start = end
+    return messages, data[start:]
+
+### SERVER ###
+
+def show_frame(payload):
+    "Copy a FRAME into the arena."
+    mask, data = ord(payload[0]), payload[1:]
+    if len(data) != len(arena.arena):
+        raise Exception("The frame doesn't match mode "+arena.MODE)
+    arena.arena[:] = data
+    if arena.MODE == "DUPLICATE":
+        arena.panel_on = [bool(mask >> i & 1) for i in range(len(arena.pins))]
+    arena.changed_panels = [True] * arena.npanels
+
+def show_updates(payload):
+    "Copy the panel updates of an UPDATES message into the arena."
+    pbytes = len(arena.arena) // arena.npanels
+    step = pbytes + 1
+    if len(payload) % step != 0:
+        raise Exception("The updates don't match mode "+arena.MODE)
+    for start in range(0, len(payload), step):
+        mask, data = ord(payload[start]), payload[start+1:start+step]
+        if arena.npanels > 1:
+            for p in range(arena.npanels):
+                if not mask >> p & 1: continue
+                arena.arena[p*pbytes:(p+1)*pbytes] = data
+                arena.changed_panels[p] = True
+        else:
+            # a single panel goes to different pins with each update
+            show_frame(payload[start:start+step])
+            arena.render()
+
+def handle(kind, payload):
+    "Execute a message (other than ACK)."
+    if kind == MODE_MSG:
+        arena.set_mode(payload)
+    elif kind == FRAME:
+        show_frame(payload)
+    elif kind == UPDATES:
+        show_updates(payload)
+    elif kind == BRIGHTNESS:
+        # (gamma correction is applied by the controller as it draws)
+        arena.set_brightness(float(payload), arena.gamma)
+    elif kind != PING:
+        raise Exception("Unknown message type %d" % kind)
+    if kind != PING: arena.render()
+
+def serve(port=None):
+    "Run a frame server, showing the frames of any connected controllers."
+    global default_port
+    if port is None: port = default_port
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(("", port))
+    server.listen(5)
+    # received data of each client that doesn't form a whole message yet
+    clients = {}
+    arena.set_double_buffer(True)
+    arena.clear()
+    try:
+        while True:
+            readable = select.select([server] + clients.keys(), [], [])[0]
+            for s in readable:
+                if s is server:
+                    client = server.accept()[0]
+                    client.setsockopt(socket.IPPROTO_TCP,
+                                      socket.TCP_NODELAY, 1)
+                    clients[client] = ""
+                    continue
+                data = s.recv(65536)
+                if not data:
+                    del clients[s]
+                    s.close()
+                    continue
+                messages, clients[s] = split_messages(clients[s] + data)
+                acks = []
+                for kind, seq, timestamp, payload in messages:
+                    try:
+                        handle(kind, payload)
+                    except Exception as e:
+                        # a broken message can't be resynchronised
+                        print "Error:", e
+                        del clients[s]
+                        s.close()
+                        break
+                    acks.append(message(ACK, seq, timestamp))
+                else:
+                    if acks: s.sendall("".join(acks))
+    finally:
+        for s in clients: s.close()
+        server.close()
+
+### CLIENT ###
+
+## The connected arenas, each a dict of its socket ("socket"), address
+## ("host", "port"), next sequence number ("seq"), the number of bytes sent
+## ("sent"), the data each of its pins was last sent ("shown"), the
+## brightness it was last sent ("brightness"), the number of messages it
+## hasn't acknowledged yet ("unacked"), received data that doesn't form a
+## whole message yet ("received") and its recent round trip times in seconds
+## ("latency")
+global connections, targets, max_unacked, latency_window
+connections = []
+## The arenas that `arena.render()` sends to (None: all of them)
+targets = None
+## How many frames may be on their way to an arena before sending blocks
+max_unacked = 2
+latency_window = 1000
+
+def connect(host, port=None):
+    '''
+    Connect to an arena's frame server, and send it the current mode and
+    frame. From then on, `arena.render()` also sends each frame to it.
+    Returns the connection.
+    '''
+    global connections, default_port, latency_window
+    if port is None: port = default_port
+    s = socket.create_connection((host, port))
+    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    conn = {"socket": s, "host": host, "port": port, "seq": 0, "sent": 0,
+            "shown": None, "brightness": None, "unacked": 0,
+            "received": "",
+            "latency": collections.deque(maxlen=latency_window)}
+    connections.append(conn)
+    # TEXT mode has the same dimensions as PARALLEL, and this process doesn't
+    # print anything itself
+    if arena.MODE == "TEXT": arena.set_mode("PARALLEL")
+    # instead of sending the panel updates to the device, send the frame to
+    # the arenas
+    arena.sink = sink
+    transmit([conn], MODE_MSG, arena.MODE)
+    send([conn])
+    return conn
+
+def set_targets(conns=None):
+    '''
+    Choose the arenas that `arena.render()` sends to (default: all), e.g. to
+    show different stimuli on different arenas.
+    '''
+    global targets
+    targets = conns
+
+def set_mode(mode, conns=None):
+    '''
+    Change the mode of the arenas (default: all) and the local one (use this
+    instead of `arena.set_mode()` while connected).
+    '''
+    global connections
+    if conns is None: conns = connections
+    if mode == "TEXT": arena.set_mode("PARALLEL")
+    else: arena.set_mode(mode)
+    transmit(conns, MODE_MSG, mode)
+
+def transmit(conns, kind, payload=""):
+    "Send a message to each of the arenas, waiting if any of them lags behind."
+    global max_unacked
+    now = arena.monotonic()
+    for conn in conns:
+        while conn["unacked"] >= max_unacked: poll(conn, None)
+        data = message(kind, conn["seq"], now, payload)
+        conn["socket"].sendall(data)
+        conn["sent"] += len(data)
+        conn["seq"] += 1
+        conn["unacked"] += 1
+        if kind == MODE_MSG: conn["shown"] = None
+
+def send_brightness(conn):
+    "Send the local brightness to an arena, unless it already has it."
+    if conn["brightness"] == arena.brightness: return
+    transmit([conn], BRIGHTNESS, repr(arena.brightness))
+    conn["brightness"] = arena.brightness
+
+def panel_updates(shown):
+    '''
+    Collect the panel updates needed to bring an arena whose pins show the data
+    in shown up to date (like `arena.render()`), and update shown.
+    '''
+    pbytes = arena.pwidth*arena.height*4
+    pending, order = {}, []
+    for p in range(arena.npanels):
+        data = bytes(arena.arena[p*pbytes:(p+1)*pbytes])
+        if arena.MODE == "PARALLEL": pins = [p]
+        else: pins = [i for i in range(len(arena.pins)) if arena.panel_on[i]]
+        pins = [i for i in pins if shown[i] != data]
+        if not pins: continue
+        for i in pins: shown[i] = data
+        # panels with identical content share a single update
+        if data not in pending:
+            pending[data] = 0
+            order.append(data)
+        for i in pins: pending[data] |= 1 << i
+    return [(pending[data], data) for data in order]
+
+def send(conns=None):
+    '''
+    Send the current frame to the arenas (default: `targets`, or all of them).
+    Each arena only gets the panels it doesn't show yet; arenas that need the
+    same updates share one encoded message, and each arena gets a single send.
+    '''
+    global connections, targets
+    if conns is None:
+        if targets is not None: conns = targets
+        else: conns = connections
+    mask = sum(1 << i for i in range(len(arena.pins)) if arena.panel_on[i])
+    encoded = {}
+    for conn in conns:
+        send_brightness(conn)
+        if conn["shown"] is None:
+            # a new connection or mode: send the whole frame
+            conn["shown"] = [None] * len(arena.pins)
+            panel_updates(conn["shown"])
+            key = "frame"
+            if key not in encoded:
+                encoded[key] = (FRAME, chr(mask) + bytes(arena.arena))
+        else:
+            key = tuple(panel_updates(conn["shown"]))
+            if not key: continue
+            if key not in encoded:
+                encoded[key] = (UPDATES, "".join(chr(m) + data
+                                                 for m, data in key))
+        transmit([conn], *encoded[key])
+
+def send_updates(updates, conns=None):
+    '''
+    Send raw panel updates (a list of (mask, data) pairs, e.g. from a cache
+    file) to the arenas (default: `targets`, or all of them) as they are, and
+    record what their pins show now.
+    '''
+    global connections, targets
+    if conns is None:
+        if targets is not None: conns = targets
+        else: conns = connections
+    if not updates: return
+    updates = [(mask, bytes(data)) for mask, data in updates]
+    payload = "".join(chr(mask) + data for mask, data in updates)
+    for conn in conns:
+        send_brightness(conn)
+        if conn["shown"] is None: conn["shown"] = [None] * len(arena.pins)
+        for mask, data in updates:
+            for i in range(len(arena.pins)):
+                if mask >> i & 1: conn["shown"][i] = data
+        transmit([conn], UPDATES, payload)
+
+def sink(updates, raw=False):
+    '''
+    Send what `arena.render()` shows to the arenas (this is `arena.sink`).
+    The updates of a render are ignored, as each arena gets the panels it
+    doesn't show yet (see `send()`), but raw updates are sent as they are.
+    '''
+    if raw: send_updates(updates)
+    else: send()
+
+def poll(conn=None, timeout=0):
+    '''
+    Read the acknowledgements the arenas (default: all) have sent, recording
+    their latency. Waits up to timeout seconds for one (forever if None).
+    '''
+    global connections
+    if conn is None: conns = connections
+    else: conns = [conn]
+    if not conns: return
+    readable = select.select([c["socket"] for c in conns], [], [], timeout)[0]
+    for c in conns:
+        if c["socket"] not in readable: continue
+        data = c["socket"].recv(4096)
+        if not data:
+            raise Exception("Lost the connection to %s:%d" %
+                            (c["host"], c["port"]))
+        messages, c["received"] = split_messages(c["received"] + data)
+        now = arena.monotonic()
+        for kind, seq, timestamp, payload in messages:
+            if kind != ACK: continue
+            c["unacked"] -= 1
+            c["latency"].append(now - timestamp)
+
+def ping(conns=None):
+    "Measure the latency of the arenas (default: all) without a frame."
+    global connections
+    if conns is None: conns = connections
+    transmit(conns, PING)
+
+def sync(conns=None):
+    "Wait until the arenas (default: all) have handled everything sent so far."
+    global connections
+    if conns is None: conns = connections
+    for conn in conns:
+        while conn["unacked"] > 0: poll(conn, None)
+
+def latency_summary():
+    '''
+    Summarise the latencies as a list of rows (arena, count, mean, median,
+    95th percentile, maximum), times in milliseconds.
+    '''
+    global connections
+    rows = []
+    for conn in connections:
+        times = sorted(t*1000 for t in conn["latency"])
+        n = len(times)
+        if n == 0: continue
+        rows.append(["%s:%d" % (conn["host"], conn["port"]), n, sum(times)/n,
+                     times[n//2], times[min(n-1, int(n*0.95))], times[-1]])
+    return rows
+
+def print_latency():
+    "Print the round trip times of the messages to each arena."
+    rows = latency_summary()
+    if not rows: return
+    print "%-21s %6s %9s %9s %9s %9s" % \
+        ("arena", "n", "mean", "median", "95%", "max")
+    for row in rows:
+        print "%-21s %6d %9.3f %9.3f %9.3f %9.3f" % tuple(row)
+
+def disconnect():
+    "Close the connections to all arenas, and draw to the local device again."
+    global connections, targets
+    for conn in connections:
+        conn["socket"].close()
+    connections, targets = [], None
+    arena.sink = None
+
+def run(display_fn, addresses, mode=None):
+    '''
+    Like `arena.run()`, but show everything on the arenas at the given
+    addresses ("host" or "host:port") instead of the local device.
+    '''
+    global connections
+    try:
+        for address in addresses:
+            if ":" in address:
+                host, port = address.rsplit(":", 1)
+                connect(host, int(port))
+            else: connect(address)
+        if mode is not None: set_mode(mode)
+        display_fn()
+        sync()
+    except KeyboardInterrupt:
+        print "Terminating."
+    except Exception as e:
+        print "Error:", e
+    finally:
+        arena.print_frame_stats()
+        print_latency()
+        disconnect()
+
+def parse_args():
+    "Start a frame server ('./network.py [mode] [port]')."
+    args = sys.argv[1:]
+    mode = "PARALLEL"
+    if args and args[0] in ("TEXT", "SERIAL", "PARALLEL", "DUPLICATE"):
+        mode = args.pop(0)
+    if args: port = int(args[0])
+    else: port = None
+    arena.run(lambda: serve(port), mode)
+
+if __name__ == '__main__':
+    parse_args()
@@ -6,16 +6,17 @@
 ### University of Wuerzburg, Center for Computational and Theoretical Biology
 ### Licensed under the terms of the GNU GPLv3
 
-### Usage: './optic_flow.py <mode> <fps> <duration> <colour> <fast>', where
+### Usage: './optic_flow.py <mode> <fps> <duration> <colour> <fast> <cache>', where
 ### <mode> is one of ROTATE_RIGHT, ROTATE_LEFT, FLOW_FORWARD, FLOW_BACKWARD
 ### <fps> the frames per second for the animation
 ### <duration> is the number of updates to run the animation for
 ### <colour> is the foreground colour to use (see arena.py for options)
 ### <fast> if this is "fast" or "true", turn on fast rotation (see below)
+### <cache> if this is "cache" or "true", replay the animation from a cache file
 
 
-import arena, shape
-import sys, time
+import arena, framecache
+import sys
 
 ### SETTINGS ###
 
@@ -46,88 +47,97 @@ fg_col, bg_col = "green", "black"
 global fast
 fast = False
 
+# Record the animation once and replay it from a cache file, rather than
+# drawing each frame live (see framecache.py)
+global cache
+cache = False
+
 ### FUNCTIONS ###
 
 def panel_pattern(x_off):
-    global fg_col, bg_col
     "Draw a bar pattern on a single panel with a given offset."
     global fg_col, bg_col
-    col = fg_col
-    for x in range(arena.pwidth):
-        shape.plot(shape.vline(x+x_off), col)
-        if x == 3 or x == 11: col = bg_col
-        elif x == 7: col = fg_col
+    # four bars, each four pixels wide
+    for x in range(0, arena.pwidth, 4):
+        if x % 8 == 0: arena.fill_columns(x+x_off, x+x_off+3, fg_col)
+        else: arena.fill_columns(x+x_off, x+x_off+3, bg_col)
+
+def rotate_frame(t, cw=True):
+    "Draw and render frame t (0-7) of the rotating bar pattern."
+    global fast
+    if cw: x_offset = t
+    else: x_offset = t * (-1)
+    panel_pattern(x_offset)
+    # Theoretically, the arena should be able to render all eight
+    # panels simultaneously. However, on at least one arena, one panel
+    # develops problems with this approach. Therefore, I here revert to
+    # only updating half the panels at once. If speed is off the essence,
+    # this behaviour can be turned off using the `fast` flag.
+    if not fast:
+        arena.set_panels(0x0F) # panels 0-3
+        arena.render()
+        panel_pattern(x_offset)
+        arena.set_panels(0xF0) # panels 4-7
+    arena.render()
+
+def flow_frame(t, fw=True):
+    "Draw and render frame t (0-7) of the optic flow pattern."
+    if fw: x_left, x_right = t*(-1)+4, t
+    else: x_left, x_right = t+4, t*(-1)
+    panel_pattern(x_right)
+    arena.set_panels(0x0F) # panels 0-3
+    arena.render()
+    panel_pattern(x_left)
+    arena.set_panels(0xF0) # panels 4-7
+    arena.render()
+
+def frames(frame_fn):
+    "Yield the frames drawn by frame_fn(t), forever (see `arena.play()`)."
+    t = 0
+    while True:
+        frame_fn(t)
+        yield
+        # the pattern repeats after 8 frames
+        t = (t + 1) % 8
+
+def loop(frame_fn):
+    "Show the frames drawn by frame_fn(t) at the set framerate and duration."
+    global fps, duration
+    arena.play(frames(frame_fn), fps, duration)
 
 def rotate(cw=True):
     "Rotate the bar pattern, clockwise (if cw is True) or anticlockwise."
-    global fps, duration, fast
-    t,i = 0,0
-    while i != duration:
-        p1 = time.time() # time measuring point 1
-        if cw: x_offset = t
-        else: x_offset = t * (-1)
-        panel_pattern(x_offset)
-        # Theoretically, the arena should be able to render all eight
-        # panels simultaneously. However, on at least one arena, one panel
-        # develops problems with this approach. Therefore, I here revert to
-        # only updating half the panels at once. If speed is off the essence,
-        # this behaviour can be turned off using the `fast` flag.
-        if not fast:
-            for p in range(8):
-                if p < 4: arena.toggle_panel(p, True)
-                else: arena.toggle_panel(p, False)
-            arena.render()
-            panel_pattern(x_offset)
-            for p in range(8):
-                if p < 4: arena.toggle_panel(p, False)
-                else: arena.toggle_panel(p, True)
-        arena.render()
-        p2 = time.time() # time measuring point 2
-        sleep_time = (1.0/fps) - (p2-p1)
-        if sleep_time > 0: time.sleep(sleep_time)
-        if t < 7: t = t+1
-        else: t = 0
-        i = i + 1
+    loop(lambda t: rotate_frame(t, cw))
 
 def flow(fw=True):
     "Show the optic flow pattern, forward (if fw is True) or backward."
-    global fps, duration
-    t,i = 0,0
-    while i != duration:
-        p1 = time.time() # time measuring point 1
-        if fw: x_left, x_right = t*(-1)+4, t
-        else: x_left, x_right = t+4, t*(-1)
-        panel_pattern(x_right)
-        for p in range(8):
-            if p < 4: arena.toggle_panel(p, True)
-            else: arena.toggle_panel(p, False)
-        arena.render()
-        panel_pattern(x_left)
-        for p in range(8):
-            if p < 4: arena.toggle_panel(p, False)
-            else: arena.toggle_panel(p, True)
-        arena.render()
-        p2 = time.time() # time measuring point 2
-        sleep_time = (1.0/fps) - (p2-p1)
-        if sleep_time > 0: time.sleep(sleep_time)
-        if t < 7: t = t+1
-        else: t = 0
-        i = i + 1
+    loop(lambda t: flow_frame(t, fw))
 
-def animate():
-    "Run the animation chosen by `mode`."
+def frame_function():
+    "Return the function that draws a frame of the animation chosen by `mode`."
     global mode
     if mode == "ROTATE_RIGHT":
-        rotate(True)
+        return lambda t: rotate_frame(t, True)
     elif mode == "ROTATE_LEFT":
-        rotate(False)
+        return lambda t: rotate_frame(t, False)
     elif mode == "FLOW_FORWARD":
-        flow(True)
+        return lambda t: flow_frame(t, True)
     elif mode == "FLOW_BACKWARD":
-        flow(False)
+        return lambda t: flow_frame(t, False)
     else:
         raise Exception("Invalid mode "+mode)
 
+def animate():
+    "Run the animation chosen by `mode`."
+    global mode, fps, duration, fg_col, bg_col, fast, cache
+    if cache:
+        # the pattern repeats after 8 frames
+        params = {"mode":mode, "fg_col":fg_col, "bg_col":bg_col, "fast":fast}
+        path = framecache.cached("optic_flow", params, frame_function(), 8)
+        framecache.play(path, fps, duration)
+    else:
+        loop(frame_function())
+
 def parse_args():
     '''
     Set parameters from the commandline by argument index.
@@ -136,9 +146,10 @@ def parse_args():
     3rd param: duration
     4th param: colour
     5th param: fast mode
+    6th param: cache
     '''
-    global options, mode, fps, duration, fg_col, fast
-    if len(sys.argv) > 6:
+    global options, mode, fps, duration, fg_col, fast, cache
+    if len(sys.argv) > 7:
         raise Exception("Bad number of args. See the source for details.")
     if len(sys.argv) >= 2:
         mode = sys.argv[1]
@@ -154,6 +165,9 @@ def parse_args():
     if len(sys.argv) >= 6:
         if sys.argv[5] in ("fast", "True", "true", "TRUE"):
             fast = True
+    if len(sys.argv) >= 7:
+        if sys.argv[6] in ("cache", "True", "true", "TRUE"):
+            cache = True
 
 if __name__ == '__main__':
     parse_args()
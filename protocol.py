@@ -0,0 +1,285 @@
+#!/usr/bin/python2
+### Control the LEDs in the ZooII Monarch butterfly arena.
+###
+### Run a whole experimental session from a protocol file. The protocol
+### describes a sequence of trials (which stimulus, its colours, direction,
+### framerate and duration), using the animations of the other scripts. All
+### trials are compiled into cache files (see framecache.py) before the session
+### starts, and checked against the time the bus needs to send each frame. The
+### session is then played with each trial starting exactly when the previous
+### one ends.
+###
+### Usage: './protocol.py <protocol file> [check] [verify] [workers]' (with
+### 'check', only compile and check the session; with a number of workers,
+### record the frames in that many processes, and with 'verify', make sure
+### that this gives the same frames as recording them in one).
+###
+### A protocol file is a JSON object like this:
+###   {"mode": "DUPLICATE",
+###    "trials": [{"stimulus": "optic_flow", "direction": "ROTATE_LEFT",
+###                "fps": 21, "duration": 5, "fg_col": "green"},
+###               {"stimulus": "blank", "colour": "black", "duration": 2}]}
+### "mode" is the arena mode for the whole session (default: PARALLEL). Each
+### trial has a "duration" in seconds (or a number of "frames") and an "fps"
+### (default: 21), and the settings of its stimulus:
+###   optic_flow: "direction" (one of `optic_flow.options`), "fg_col", "bg_col",
+###               "fast" (DUPLICATE mode only)
+###   dot_bar:    "dot_mode", "bar_mode", "bg_col", "bar_col", "dot_col",
+###               "direction" (1 or -1: the animation runs backwards)
+###   landscape:  "direction" (1 or -1)
+###   blank:      "colour"
+### Colours are names (see `arena.colours`) or [r, g, b] lists.
+###
+### Licensed under the terms of the GNU GPLv3
+
+import os, sys, json
+import arena, framecache
+
+### STIMULI ###
+
+## Each stimulus is set up by a function that takes the trial's settings and
+## returns the name, parameters (identifying the cache file), frame function
+## and period in frames of its animation
+
+def optic_flow_trial(trial):
+    "Set up an optic_flow.py animation."
+    import optic_flow
+    if arena.MODE != "DUPLICATE":
+        raise Exception("optic_flow only works in DUPLICATE mode.")
+    optic_flow.mode = trial.get("direction", "ROTATE_RIGHT")
+    if optic_flow.mode not in optic_flow.options:
+        raise Exception("Invalid direction "+str(optic_flow.mode))
+    optic_flow.fg_col = trial.get("fg_col", "green")
+    optic_flow.bg_col = trial.get("bg_col", "black")
+    optic_flow.fast = bool(trial.get("fast", False))
+    params = {"mode":optic_flow.mode, "fg_col":optic_flow.fg_col,
+              "bg_col":optic_flow.bg_col, "fast":optic_flow.fast}
+    # the pattern repeats after 8 frames
+    return "optic_flow", params, optic_flow.frame_function(), 8
+
+def dot_bar_trial(trial):
+    "Set up a dot_bar.py animation."
+    import dot_bar
+    dot_bar.dot_mode = int(trial.get("dot_mode", 2))
+    dot_bar.bar_mode = int(trial.get("bar_mode", 1))
+    dot_bar.bg_col = trial.get("bg_col", "blue")
+    dot_bar.bar_col = trial.get("bar_col", "black")
+    dot_bar.dot_col = trial.get("dot_col", "green")
+    params = {"dot_mode":dot_bar.dot_mode, "bar_mode":dot_bar.bar_mode,
+              "bg_col":dot_bar.bg_col, "bar_col":dot_bar.bar_col,
+              "dot_col":dot_bar.dot_col}
+    return "dot_bar", params, dot_bar.draw_frame, arena.width
+
+def landscape_trial(trial):
+    "Set up a landscape.py animation."
+    import landscape
+    return "landscape", {}, landscape.draw_frame, arena.width
+
+def blank_trial(trial):
+    "Set up a plain screen."
+    colour = trial.get("colour", "black")
+    arena.colour_value(colour) # (fail early on unknown colours)
+    def frame(t):
+        arena.clear_layers()
+        arena.clear(colour, show=False)
+    return "blank", {"colour":colour}, frame, 1
+
+global stimuli
+stimuli = {"optic_flow": optic_flow_trial, "dot_bar": dot_bar_trial,
+           "landscape": landscape_trial, "blank": blank_trial}
+
+### COMPILER ###
+
+def plain(value):
+    '''
+    Convert the unicode strings read from JSON into plain strings, and lists
+    of three numbers (RGB colours) into tuples.
+    '''
+    if isinstance(value, unicode): return str(value)
+    elif isinstance(value, list):
+        if len(value) == 3 and all(isinstance(v, (int, long, float)) and
+                                   not isinstance(v, bool) for v in value):
+            return tuple(value)
+        return [plain(v) for v in value]
+    elif isinstance(value, dict):
+        return dict((plain(k), plain(v)) for k, v in value.items())
+    else: return value
+
+def load_protocol(path):
+    "Read a protocol file."
+    f = open(path)
+    try:
+        protocol = plain(json.load(f))
+    finally:
+        f.close()
+    if not isinstance(protocol, dict) or "trials" not in protocol:
+        raise Exception(path+" is not a valid protocol file.")
+    return protocol
+
+def frame_time(updates, pbytes):
+    "The time the bus needs to send a frame, given as a list of updates."
+    return len(updates) * arena.transfer_time(pbytes // 4)
+
+def setup_trial(trial):
+    '''
+    Set up a trial's stimulus. Returns the name, parameters, frame function and
+    period of its animation (see `stimuli`), taking its direction into account.
+    '''
+    global stimuli
+    stimulus = trial.get("stimulus")
+    if stimulus not in stimuli:
+        raise Exception("unknown stimulus "+str(stimulus))
+    name, params, frame_fn, period = stimuli[stimulus](trial)
+    direction = trial.get("direction", 1)
+    if direction == -1:
+        params["direction"] = -1
+        frame_fn = (lambda fn, n: lambda t: fn(-t % n))(frame_fn, period)
+    elif stimulus != "optic_flow" and direction != 1:
+        raise Exception("invalid direction "+str(direction))
+    return name, params, frame_fn, period
+
+def trial_frame_fn(trial):
+    "The frame function of a trial (for `framecache.compile_batch()`)."
+    return setup_trial(trial)[2]
+
+def compile_session(protocol, workers=1, verify=False):
+    '''
+    Compile all trials of a protocol (a dict, or the path of a protocol file)
+    into cache files (one per animation), in the protocol's mode. Returns the
+    session as a list of segments, each a dict of the trial's "stimulus",
+    cache file "path", "fps", number of "frames", and the time the bus needs
+    for its slowest frame ("worst") compared to the time each frame may take
+    ("budget"), and the "workers" that recorded it (see
+    `framecache.worker_stats`).
+    workers: The number of processes that record the trials (None: one per
+             CPU core). They share one pool, each recording whole trials
+             (see `framecache.compile_batch()`).
+    verify: When recording in several processes, check that the cache files
+            are identical to those recorded in a single one
+    '''
+    if not isinstance(protocol, dict): protocol = load_protocol(protocol)
+    mode = protocol.get("mode", "PARALLEL")
+    if mode == "TEXT":
+        raise Exception("Sessions cannot be compiled in TEXT mode.")
+    session, pending = [], {}
+    for i, trial in enumerate(protocol["trials"]):
+        stimulus = trial.get("stimulus")
+        fps = float(trial.get("fps", 21))
+        if "frames" in trial: frames = int(trial["frames"])
+        elif "duration" in trial: frames = int(round(trial["duration"] * fps))
+        else: raise Exception("Trial %d has no duration." % (i+1))
+        # every trial starts from a cleared arena, with all panels on
+        arena.set_mode(mode)
+        try:
+            name, params, frame_fn, period = setup_trial(trial)
+        except Exception as e:
+            raise Exception("Trial %d: %s" % (i+1, e))
+        # each animation is drawn by the module it is named after (the
+        # blank screen by this one)
+        module = sys.modules.get(name, sys.modules[__name__])
+        path = framecache.cache_path(name, params, module)
+        if not os.path.exists(path):
+            if workers == 1:
+                framecache.compile_animation(frame_fn, period, path)
+            elif path not in pending:
+                pending[path] = (trial_frame_fn, (trial,), period, path)
+        session.append({"stimulus": stimulus, "path": path, "fps": fps,
+                        "frames": frames, "budget": 1.0/fps, "workers": {}})
+    if pending:
+        # the trials are independent, so one pool records all of them
+        arena.set_mode(mode)
+        animations = pending.values()
+        stats = framecache.compile_batch(animations, workers, verify=verify)
+        stats = dict((a[3], s) for a, s in zip(animations, stats))
+        for segment in session:
+            segment["workers"] = stats.pop(segment["path"], {})
+    # check the frames against the bus timing
+    for segment in session:
+        data, pbytes, updates = framecache.load(segment["path"])
+        data.close()
+        segment["worst"] = max(frame_time(u, pbytes) for u in updates)
+    return session
+
+def check_session(session):
+    "Raise an exception if any trial's frames can't be sent in time."
+    slow = ["%d (%s: %.2f ms per frame, %.2f ms needed)" %
+            (i+1, s["stimulus"], s["budget"]*1000, s["worst"]*1000)
+            for i, s in enumerate(session) if s["worst"] > s["budget"]]
+    if slow:
+        raise Exception("Trials too fast for the bus: "+", ".join(slow))
+
+def print_session(session):
+    "Print the trials of a compiled session and their frame budgets."
+    print "%5s %-12s %7s %7s %9s %11s" % \
+        ("trial", "stimulus", "fps", "frames", "budget", "worst frame")
+    for i, s in enumerate(session):
+        print "%5d %-12s %7.2f %7d %6.2f ms %8.2f ms" % \
+            (i+1, s["stimulus"], s["fps"], s["frames"], s["budget"]*1000,
+             s["worst"]*1000)
+        for pid in sorted(s["workers"]):
+            frames, seconds = s["workers"][pid]
+            print "      recorded by worker %d: %d frames at %.1f fps" % \
+                (pid, frames, frames / max(seconds, 1e-9))
+    total = sum(s["frames"] / s["fps"] for s in session)
+    print "Session length: %.2f s" % total
+
+### PLAYER ###
+
+def play_session(session):
+    '''
+    Play a compiled session. Each trial starts at the deadline after the last
+    frame of the previous one, so there are no gaps in between. Returns the
+    frame statistics of each trial (see `arena.frame_stats`).
+    '''
+    # map every cache file before the first frame
+    segments = [framecache.load(s["path"]) for s in session]
+    arena.wait() # don't interfere with frames that are still being sent
+    stats = []
+    try:
+        start = arena.monotonic()
+        for s, (frames, pbytes, updates) in zip(session, segments):
+            def frame(t):
+                for mask, offset in updates[t]:
+                    arena.output(mask, frames[offset:offset+pbytes])
+            # frames only contain the panels that changed, so none may be
+            # dropped
+            arena.animate(frame, s["fps"], s["frames"], late="render",
+                          period=len(updates), start=start)
+            stats.append(dict(arena.frame_stats))
+            start = start + s["frames"] / s["fps"]
+    finally:
+        for frames, pbytes, updates in segments: frames.close()
+        arena.shown = [None] * len(arena.pins)
+    return stats
+
+def run_protocol(path, check_only=False, workers=1, verify=False):
+    '''
+    Compile, check and (unless check_only) play a protocol file. (workers and
+    verify: see `compile_session()`)
+    '''
+    session = compile_session(path, workers, verify)
+    print_session(session)
+    check_session(session)
+    if check_only: return
+    for i, stats in enumerate(play_session(session)):
+        print "Trial %d: %d frames shown, %d late" % \
+            (i+1, stats["shown"], stats["late"])
+
+def parse_args():
+    "Run a protocol file (see the usage note above)."
+    if len(sys.argv) < 2:
+        print "Usage: ./protocol.py <protocol file> [check] [verify] [workers]"
+        sys.exit(1)
+    protocol = load_protocol(sys.argv[1])
+    options = sys.argv[2:]
+    workers = 1
+    for option in options:
+        if option.isdigit(): workers = int(option)
+        elif option not in ("check", "verify"):
+            raise Exception("Unknown option "+option)
+    arena.run(lambda: run_protocol(protocol, "check" in options, workers,
+                                   "verify" in options),
+              protocol.get("mode", "PARALLEL"))
+
+if __name__ == '__main__':
+    parse_args()
@@ -9,43 +9,147 @@
 ### University of Wuerzburg, Center for Computational and Theoretical Biology
 ### Licensed under the terms of the GNU GPLv3
 
-import math
+import math, collections
 import arena
 
-def plot(coords, colour="green", flush=False):
+def plot(coords, colour="green", flush=False, dx=0, dy=0):
     '''
     Draw a shape from a list of coordinates (as produced by the shape functions).
     colour: The colour to use
     flush: If true, will output the result immediately
+    dx, dy: Move the shape by this many pixels
     '''
-    for c in coords:
-        arena.set_pixel(c[0], c[1], colour)
+    if arena.profiling: begin = arena.monotonic()
+    arena.set_pixels(coords, colour, dx, dy)
+    if arena.profiling: arena.profile_time("draw", arena.monotonic() - begin)
     if flush: arena.render()
 
+def plot_spans(spans, colour="green", flush=False, dx=0, dy=0):
+    '''
+    Draw a shape from a list of spans (as produced by the shape functions when
+    called with `spans=True`).
+    colour: The colour to use
+    flush: If true, will output the result immediately
+    dx, dy: Move the shape by this many pixels
+    '''
+    if arena.profiling: begin = arena.monotonic()
+    arena.fill_spans(spans, colour, dx, dy)
+    if arena.profiling: arena.profile_time("draw", arena.monotonic() - begin)
+    if flush: arena.render()
+
+## SHAPE CACHE
+## Animations draw the same shapes over and over again, often at different
+## positions. Therefore, each shape is built once at the origin and cached,
+## and only moved into place when it is requested.
+
+# The maximum number of shapes to keep (least recently used ones are dropped)
+global cache_size
+cache_size = 256
+
+global shape_cache, cache_stats
+shape_cache = collections.OrderedDict()
+cache_stats = {"hits": 0, "misses": 0}
+
+def cached(build, x, y, args, spans=False):
+    '''
+    Get the shape constructed by `build(*args)` from the cache (building and
+    storing it first if necessary), and move it to x/y. args must describe the
+    shape relative to the origin.
+    '''
+    global shape_cache, cache_size, cache_stats
+    if arena.profiling: begin = arena.monotonic()
+    key = (build.__name__,) + args
+    shape = shape_cache.pop(key, None)
+    if shape is None:
+        shape = tuple(build(*args))
+        cache_stats["misses"] += 1
+    else: cache_stats["hits"] += 1
+    shape_cache[key] = shape # now the most recently used
+    while len(shape_cache) > cache_size:
+        shape_cache.popitem(last=False)
+    if x == 0 and y == 0: shape = list(shape)
+    elif spans: shape = [(sy+y, x1+x, x2+x) for sy, x1, x2 in shape]
+    else: shape = [(cx+x, cy+y) for cx, cy in shape]
+    if arena.profiling: arena.profile_time("shape", arena.monotonic() - begin)
+    return shape
+
+def clear_cache():
+    "Empty the shape cache and reset its statistics."
+    global shape_cache, cache_stats
+    shape_cache.clear()
+    cache_stats.update(hits=0, misses=0)
+
 ## SHAPE DEFINITIONS
-## A shape is a list of coordinate tuples whose pixels are to be drawn
+## A shape is a list of coordinate tuples whose pixels are to be drawn.
+## Alternatively, the shape functions can return a list of spans (see below).
+## (The `make_*` functions do the actual work, the shape functions look up
+## their results in the cache.)
 
-def hline(x1, x2, y):
+def hline(x1, x2, y, spans=False):
     "A horizontal line from x1/y to x2/y"
+    return cached(make_hline, x1, y, (0, x2-x1, 0, spans), spans)
+
+def vline(x, y1=0, y2=None, spans=False):
+    "A vertical line from x/y1 to x/y2 (default: the bottom of the arena)"
+    if y2 is None: y2 = arena.height-1
+    return cached(make_vline, x, y1, (0, 0, y2-y1, spans), spans)
+
+def line(x1, y1, x2, y2, spans=False):
+    "A straight line from x1/y1 to x2/y2"
+    return cached(make_line, x1, y1, (0, 0, x2-x1, y2-y1, spans), spans)
+
+def polygon(corners, filled=True, spans=False):
+    "A polygon connecting each set of coordinates passed to it via straight lines"
+    x, y = corners[0]
+    corners = tuple((c[0]-x, c[1]-y) for c in corners)
+    return cached(make_polygon, x, y, (corners, filled, spans), spans)
+
+def triangle(x1, y1, x2, y2, x3, y3, filled=True, spans=False):
+    corners = ((x1,y1), (x2,y2), (x3,y3))
+    return polygon(corners, filled, spans)
+
+def rectangle(x1, y1, x2, y2, x3, y3, x4, y4, filled=True, spans=False):
+    '''
+    Draw a shape with four sides (doesn't strictly have to be a rectangle).
+    filled: if false, simply returns the outline
+    '''
+    corners = ((x1,y1), (x2,y2), (x3,y3), (x4,y4))
+    return polygon(corners, filled, spans)
+
+def circle(center_x, center_y, radius, filled=True, quarters=[1,2,3,4],
+           spans=False):
+    '''
+    Draw a circle, defined by its center point and radius.
+    filled: if false, will only draw the outline
+    quarters: quarters of the circle to draw (1.TR, 2.BR, 3.BL, 4.TL)
+    '''
+    return cached(make_circle, center_x, center_y,
+                  (0, 0, radius, filled, tuple(quarters), spans), spans)
+
+def make_hline(x1, x2, y, spans=False):
+    "Build a horizontal line at the given position (see `hline()`)."
     shape = []
     if x2 < x1: x2,x1 = x1,x2
+    if spans: return [(y, x1, x2)]
     for x in range(x1, x2+1):
         shape.append((x,y))
     return shape
 
-def vline(x, y1=0, y2=arena.height-1):
-    "A vertical line from x/y1 to x/y2"
+def make_vline(x, y1, y2, spans=False):
+    "Build a vertical line at the given position (see `vline()`)."
     shape = []
     if y2 < y1: y2,y1 = y1,y2
+    if spans: return [(y, x, x) for y in range(y1, y2+1)]
     for y in range(y1, y2+1):
         shape.append((x,y))
     return shape
 
-def line(x1, y1, x2, y2):
-    "A straight line from x1/y1 to x2/y2"
+def make_line(x1, y1, x2, y2, spans=False):
+    "Build a line at the given position (see `line()`)."
     # Special cases for improved performance
-    if x1 == x2: return vline(x1, y1, y2)
-    if y1 == y2: return hline(x1, x2, y1)
+    if x1 == x2: return make_vline(x1, y1, y2, spans)
+    if y1 == y2: return make_hline(x1, x2, y1, spans)
+    if spans: return coord_spans(make_line(x1, y1, x2, y2))
     # This is a backport to Python from my Common Lisp croatoan `shapes` extension
     # (https://github.com/McParen/croatoan/blob/master/source/shape.lisp)
     # The idea is to move from left to right one step at a time, calculating how
@@ -82,8 +186,8 @@ def line(x1, y1, x2, y2):
         x = x+1
     return shape
 
-def polygon(corners, filled=True):
-    "A polygon connecting each set of coordinates passed to it via straight lines"
+def make_polygon(corners, filled=True, spans=False):
+    "Build a polygon at the given position (see `polygon()`)."
     shape = line(corners[len(corners)-1][0],
                  corners[len(corners)-1][1],
                  corners[0][0],
@@ -93,27 +197,21 @@ def polygon(corners, filled=True):
                           corners[c][1],
                           corners[c+1][0],
                           corners[c+1][1]))
-    if filled: return fill_shape(shape)
-    else: return shape
-
-def triangle(x1, y1, x2, y2, x3, y3, filled=True):
-    corners = ((x1,y1), (x2,y2), (x3,y3))
-    return polygon(corners, filled)
-
-def rectangle(x1, y1, x2, y2, x3, y3, x4, y4, filled=True):
-    '''
-    Draw a shape with four sides (doesn't strictly have to be a rectangle).
-    filled: if false, simply returns the outline
-    '''
-    corners = ((x1,y1), (x2,y2), (x3,y3), (x4,y4))
-    return polygon(corners, filled)
+    if spans:
+        if filled: return merge_spans(coord_spans(shape)+polygon_spans(corners))
+        else: return coord_spans(shape)
+    if filled: shape.extend(span_coords(polygon_spans(corners)))
+    return shape
 
-def circle(center_x, center_y, radius, filled=True, quarters=[1,2,3,4]):
-    '''
-    Draw a circle, defined by its center point and radius.
-    filled: if false, will only draw the outline
-    quarters: quarters of the circle to draw (1.TR, 2.BR, 3.BL, 4.TL)
-    '''
+def make_circle(center_x, center_y, radius, filled=True, quarters=(1,2,3,4),
+                spans=False):
+    "Build a circle at the given position (see `circle()`)."
+    if filled and sorted(quarters) == [1,2,3,4]:
+        if spans: return circle_spans(center_x, center_y, radius)
+        return span_coords(circle_spans(center_x, center_y, radius))
+    if spans:
+        return coord_spans(make_circle(center_x, center_y, radius, filled,
+                                       quarters))
     shape = []
     for x in range(radius+1):
         for y in range(radius+1):
@@ -125,8 +223,87 @@ def circle(center_x, center_y, radius, filled=True, quarters=[1,2,3,4]):
                 if 4 in quarters: shape.append((center_x-y, center_y-x))
     return shape
 
+## SPANS
+## A span is a (y, x1, x2) tuple standing for a horizontal run of pixels.
+## Filled shapes are rasterized as spans, one row at a time. Pass `spans=True`
+## to a shape function to get its spans instead of its coordinates, and draw
+## them with `plot_spans()`.
+
+def polygon_spans(corners):
+    '''
+    Get the spans that fill the inside of a polygon (even-odd rule, so this
+    also works for concave polygons). Each row is sampled at its pixel
+    centers; pixels on the outline itself may be missing.
+    '''
+    # the edge table: all non-horizontal edges, sorted by their top end
+    edges = []
+    for c in range(len(corners)):
+        x1, y1 = corners[c-1]
+        x2, y2 = corners[c]
+        if y1 == y2: continue
+        if y2 < y1: x1,y1,x2,y2 = x2,y2,x1,y1
+        edges.append((y1, y2, x1, float(x2-x1)/(y2-y1)))
+    edges.sort()
+    spans = []
+    active = []
+    e = 0
+    min_y = min(c[1] for c in corners)
+    max_y = max(c[1] for c in corners)
+    for y in range(min_y, max_y+1):
+        # update the list of edges crossing this row (top end inclusive,
+        # bottom end exclusive, so that vertices are not counted twice)
+        while e < len(edges) and edges[e][0] <= y:
+            active.append(edges[e])
+            e = e + 1
+        active = [a for a in active if a[1] > y]
+        crossings = sorted(a[2] + (y-a[0])*a[3] for a in active)
+        for i in range(0, len(crossings)-1, 2):
+            x1 = int(math.ceil(crossings[i]))
+            x2 = int(math.floor(crossings[i+1]))
+            if x1 <= x2: spans.append((y, x1, x2))
+    return spans
+
+def circle_spans(center_x, center_y, radius):
+    "Get the spans of a filled circle (the same pixels as `circle()` draws)."
+    spans = []
+    for y in range(-radius, radius+1):
+        # find the widest point of this row that is still inside the circle
+        x = radius
+        while round(math.sqrt(x**2+y**2)) > radius: x = x - 1
+        spans.append((center_y+y, center_x-x, center_x+x))
+    return spans
+
+def span_coords(spans):
+    "Convert a list of spans into a list of coordinates."
+    shape = []
+    for y, x1, x2 in spans:
+        shape.extend((x, y) for x in range(x1, x2+1))
+    return shape
+
+def coord_spans(shape):
+    "Convert a list of coordinates into a list of spans."
+    spans = []
+    for x, y in sorted(set(shape), key=lambda c: (c[1], c[0])):
+        if spans and spans[-1][0] == y and spans[-1][2] == x-1:
+            spans[-1] = (y, spans[-1][1], x)
+        else: spans.append((y, x, x))
+    return spans
+
+def merge_spans(spans):
+    "Combine overlapping or adjacent spans on the same row."
+    merged = []
+    for y, x1, x2 in sorted(spans):
+        if merged and merged[-1][0] == y and merged[-1][2] >= x1-1:
+            merged[-1] = (y, merged[-1][1], max(x2, merged[-1][2]))
+        else: merged.append((y, x1, x2))
+    return merged
+
 def fill_shape(shape):
-    "Take a shape that only shows the borders and 'colour it out'"
+    '''
+    Take a shape that only shows the borders and 'colour it out'.
+    (The shape functions use the faster `polygon_spans()` instead, which
+    needs the corners rather than the border.)
+    '''
     # Iterate over the shape's enclosing rectangle, adding any points
     # inside the shape to its coordinate list
     filling = []